@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Checks that the DirectIP interface of relay.py reports MT messages which can not be encoded as
+# permanent failures, while an unreachable gateway is a failure the message is retried after:
+#   ./directip_mt_check.py
+import logging
+import os
+import socket
+import sys
+import tornado.ioloop
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import directip
+import relay
+
+IMEI = '300234010753370'
+
+
+def deliver(interface, imei, data):
+    ioloop = tornado.ioloop.IOLoop.current()
+    results = []
+
+    def done_callback(success, permanent=False):
+        results.append((success, permanent))
+        ioloop.stop()
+    ioloop.add_callback(interface.deliver_message, imei, data, 1, done_callback)
+    ioloop.start()
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    # a port nothing listens on
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    vehicles = relay.VehicleRegistry(0, False, 0)
+    interface = relay.DirectIpInterface(0, 'localhost', port, 1.0, True, None, vehicles)
+
+    results = deliver(interface, '123', 'payload')
+    assert results == [(False, True)], results
+    results = deliver(interface, IMEI, 'x' * (directip.MT_PAYLOAD_MAX_LENGTH + 1))
+    assert results == [(False, True)], results
+    results = deliver(interface, IMEI, 'payload')
+    assert results == [(False, False)], results
+    print('DirectIP MT OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Measures the CPU time relay.py spends per LTE datagram for different batch sizes. In every round the
+# socket buffer is filled while the IOLoop is not running and then drained, like during a burst of the
+# plane. With --baseline the LteInterface of relay.py at that git revision (one datagram per wakeup
+# under a lock, sys.getsizeof and logging per datagram) is measured as well:
+#   ./lte_ingest_benchmark.py [--packets N] [--round N] [--baseline REVISION] [BATCH_SIZE ...]
+import argparse
+import imp
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import tornado.ioloop
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import relay
+
+PORT = 30100
+RECEIVE_BUFFER = 4194304
+# HEARTBEAT of system 1 as sent by the autopilot
+FRAME = 'fd09000000010100000000000000020c5103039b3e'.decode('hex')
+
+
+class Counter:
+    def __init__(self):
+        self.target = 0
+        self.received = 0
+        self.last = None
+
+    def on_batch(self, batch):
+        self.received += len(batch)
+        self.last = time.time()
+        if self.received >= self.target:
+            tornado.ioloop.IOLoop.current().stop()
+
+
+def load_baseline(revision):
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    source = subprocess.check_output(['git', 'show', revision + ':relay.py'], cwd=directory)
+    module = imp.new_module('baseline_relay')
+    exec compile(source, 'baseline_relay.py', 'exec') in module.__dict__
+    return module
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(packets, round_size, batch_size, baseline_revision):
+    ioloop = tornado.ioloop.IOLoop()
+    ioloop.make_current()
+    counter = Counter()
+    if batch_size == 'baseline':
+        # the module is kept, python 2 clears the globals of a module once it is collected
+        baseline = load_baseline(baseline_revision)
+        li = baseline.LteInterface(PORT, 600)
+        li.on_message_callback = lambda data: counter.on_batch([data])
+        li.open()
+        li._LteInterface__sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    else:
+        vehicles = relay.VehicleRegistry(0, True, 1)
+        vehicles.on_vehicle_added_callback = lambda vehicle: None
+        li = relay.LteInterface(PORT, 600, vehicles, batch_size, receive_buffer=RECEIVE_BUFFER)
+        li.on_batch_callback = counter.on_batch
+        li.open()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    cpu = 0.0
+    duration = 0.0
+    sent = 0
+    while sent < packets:
+        count = min(round_size, packets - sent)
+        for i in range(count):
+            sock.sendto(FRAME, ('localhost', PORT))
+        sent += count
+        counter.target += count
+        counter.last = None
+
+        # the round ends once everything is received or nothing arrived for a while, the kernel may
+        # have dropped datagrams if the round does not fit the receive buffer
+        def check_idle():
+            if time.time() - (counter.last or start) > 0.2:
+                ioloop.stop()
+            else:
+                ioloop.call_later(0.05, check_idle)
+        timeout = ioloop.call_later(0.05, check_idle)
+        start = time.time()
+        cpu_start = cpu_time()
+        ioloop.start()
+        cpu += cpu_time() - cpu_start
+        duration += (counter.last or start) - start
+        ioloop.remove_timeout(timeout)
+        counter.target = counter.received
+    sock.close()
+    li.close()
+    ioloop.close()
+
+    print 'batch size %8s: received %d/%d packets, %.0f packets/s, %.2f us CPU per packet' % (
+        batch_size, counter.received, packets, counter.received / duration if duration > 0 else 0,
+        1e6 * cpu / max(1, counter.received))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the LTE ingest of relay.py.')
+    parser.add_argument('batch_sizes', nargs='*', type=int, default=[1, 64], help='Batch sizes of the LTE interface')
+    parser.add_argument('--packets', type=int, default=200000, help='Datagrams sent per batch size')
+    parser.add_argument('--round', type=int, default=2000, help='Datagrams sent per burst, must fit the receive buffer')
+    parser.add_argument('--baseline', help='Git revision of relay.py to compare against, e.g. the first commit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    batch_sizes = (['baseline'] if args.baseline else []) + args.batch_sizes
+    for batch_size in batch_sizes:
+        run(args.packets, args.round, batch_size, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# Checks that the MO history of relay.py can be appended to and queried after a restart when its log
+# holds records older than max_age, which are compacted when the log is opened:
+#   ./mo_history_check.py
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import relay
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        vehicle = relay.Vehicle('plane1', 1, '111', 1000)
+        now = time.time()
+        # the relay was stopped with an expired and a recent record in the log
+        with open(os.path.join(directory, 'plane1.log'), 'wb') as f:
+            for received, data in [(now - 7200, 'expired'), (now - 60, 'recent')]:
+                f.write(relay.MoHistory.RECORD_HEADER.pack(received, len(data)) + data)
+
+        history = relay.MoHistory(directory, 3600)
+        history.append(vehicle, 'new', now)
+        records = history.query(vehicle, now - 600)
+        assert [data for received, data in records] == ['recent', 'new'], records
+
+        # the appended record is on disk after another restart
+        history = relay.MoHistory(directory, 3600)
+        records = history.query(vehicle, now - 600)
+        assert [data for received, data in records] == ['recent', 'new'], records
+        print('MO history OK')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# Minimal MQTT 3.1.1 broker standing in for mosquitto in benchmarks and tests:
+#   ./mqtt_stub_broker.py [PORT]
+# Accepts any credentials, grants QoS 0 for all subscriptions and keeps retained messages.
+# Sessions, wills and QoS > 0 towards the subscribers are not supported.
+import logging
+import struct
+import sys
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
+
+LOGGER = logging.getLogger(__name__)
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_packet(packet_type, flags, body):
+    header = bytearray([packet_type << 4 | flags])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+def encode_string(value):
+    return struct.pack('>H', len(value)) + value
+
+
+def decode_string(body, offset):
+    length = struct.unpack_from('>H', body, offset)[0]
+    return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+class Client:
+    def __init__(self, broker, stream):
+        self.broker = broker
+        self.stream = stream
+        self.subscriptions = set()
+
+    def send(self, data):
+        if not self.stream.closed():
+            self.stream.write(data)
+
+    @tornado.gen.coroutine
+    def run(self):
+        try:
+            while True:
+                first = ord((yield self.stream.read_bytes(1)))
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = ord((yield self.stream.read_bytes(1)))
+                    length += (byte & 0x7f) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = (yield self.stream.read_bytes(length)) if length else ''
+                if not self.handle(first >> 4, first & 0x0f, body):
+                    break
+        except tornado.iostream.StreamClosedError:
+            pass
+        self.stream.close()
+        self.broker.clients.discard(self)
+
+    def handle(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            self.send(encode_packet(CONNACK, 0, '\x00\x00'))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic, offset = decode_string(body, 0)
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.send(encode_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+            self.broker.publish(topic, body[offset:], flags & 0x01)
+        elif packet_type == PUBREL:
+            self.send(encode_packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            offset = 2
+            granted = ''
+            topic_filters = []
+            while offset < len(body):
+                topic_filter, offset = decode_string(body, offset)
+                offset += 1
+                self.subscriptions.add(topic_filter)
+                topic_filters.append(topic_filter)
+                granted += '\x00'
+            self.send(encode_packet(SUBACK, 0, body[:2] + granted))
+            for topic, payload in self.broker.retained.items():
+                if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters):
+                    self.send(encode_packet(PUBLISH, 1, encode_string(topic) + payload))
+        elif packet_type == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                topic_filter, offset = decode_string(body, offset)
+                self.subscriptions.discard(topic_filter)
+            self.send(encode_packet(UNSUBACK, 0, body[:2]))
+        elif packet_type == PINGREQ:
+            self.send(encode_packet(PINGRESP, 0, ''))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+
+class StubBroker(tornado.tcpserver.TCPServer):
+    def __init__(self):
+        tornado.tcpserver.TCPServer.__init__(self)
+        self.clients = set()
+        self.retained = {}
+        self.published = 0
+
+    def handle_stream(self, stream, address):
+        client = Client(self, stream)
+        self.clients.add(client)
+        client.run()
+
+    def publish(self, topic, payload, retain):
+        self.published += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        packet = None
+        for client in self.clients:
+            if any(topic_matches(topic_filter, topic) for topic_filter in client.subscriptions):
+                if packet is None:
+                    packet = encode_packet(PUBLISH, 0, encode_string(topic) + payload)
+                client.send(packet)
+
+
+def run(port):
+    broker = StubBroker()
+    broker.listen(port, '127.0.0.1')
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARN)
+    try:
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 1883)
+    except KeyboardInterrupt:
+        pass
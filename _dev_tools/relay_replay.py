@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# Replays recorded traffic into relay.py and measures its throughput, latency and resource usage:
+#   ./relay_replay.py -f plane.tlog [-f rockblock.csv ...] [--speed 10] [--vehicles 4]
+# The relay is started in a temporary directory with its own configuration and a stub MQTT broker
+# (mqtt_stub_broker.py). tlogs, e.g. written by the relay's [recorder], are sent to the LTE UDP port
+# and RockBLOCK CSV exports are posted to the Rock7 webhook. Every vehicle replays the same traffic,
+# with its own system id and imei.
+import argparse
+import collections
+import ConfigParser
+import csv
+import gzip
+import httplib
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+import zlib
+from datetime import datetime
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import envelope
+import relay
+import mqtt_stub_broker
+from pymavlink import mavlink
+
+RELAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'relay.py')
+TLOG_TIME = struct.Struct('>Q')
+IMEI_FORMAT = '3000000000%05d'
+LTE = 'LTE_from_plane'
+LTE_ENVELOPE = 'LTE_from_plane_envelope'
+SATCOM = 'SatCom_from_plane'
+
+
+def read_tlog(filename):
+    # yields (time, frame) of a tlog, gzip compressed if the name ends with .gz
+    f = gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')
+    with f:
+        while True:
+            header = f.read(TLOG_TIME.size + 3)
+            if len(header) < TLOG_TIME.size + 3:
+                return
+            usec = TLOG_TIME.unpack_from(header)[0]
+            stx, payload_len, incompat_flags = [ord(c) for c in header[TLOG_TIME.size:]]
+            if stx == mavlink.PROTOCOL_MARKER_V1:
+                length = payload_len + 8
+            elif stx == mavlink.PROTOCOL_MARKER_V2:
+                length = payload_len + 12 + (13 if incompat_flags & mavlink.MAVLINK_IFLAG_SIGNED else 0)
+            else:
+                print 'Invalid frame in %s, stopping to read it' % filename
+                return
+            frame = header[TLOG_TIME.size:] + f.read(length - 3)
+            if len(frame) < length:
+                return
+            yield usec * 1e-6, frame
+
+
+def read_rockblock_csv(filename):
+    # yields (time, payload) of the MO messages in a RockBLOCK export, which lists the newest message first
+    messages = []
+    with open(filename, 'rb') as f:
+        for row in csv.DictReader(f):
+            if row.get('Direction', 'MO') != 'MO' or not row.get('Payload'):
+                continue
+            t = datetime.strptime(row['Date Time (UTC)'], '%d/%b/%Y %H:%M:%S')
+            messages.append(((t - datetime(1970, 1, 1)).total_seconds(), row['Payload'].decode('hex')))
+    return reversed(messages)
+
+
+def load_events(filenames, sysid):
+    # returns the (time, link, data) to replay, sorted by time
+    events = []
+    for filename in filenames:
+        if filename.endswith('.csv'):
+            events.extend((t, SATCOM, data) for t, data in read_rockblock_csv(filename))
+            continue
+        frames = list(read_tlog(filename))
+        sysids = collections.Counter(relay.mavlink_sysid(bytearray(frame), len(frame)) for t, frame in frames)
+        # tlogs of the relay hold both directions, only the frames of the plane are replayed
+        source = sysid if sysid is not None else sysids.most_common(1)[0][0] if sysids else None
+        events.extend((t, LTE, frame) for t, frame in frames
+                      if relay.mavlink_sysid(bytearray(frame), len(frame)) == source)
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def with_sysid(frame, sysid):
+    data = bytearray(frame)
+    data[3 if data[0] == mavlink.PROTOCOL_MARKER_V1 else 5] = sysid
+    return bytes(data)
+
+
+def sender(events, vehicles, speed, lte_port, http_port, results):
+    # sends the events for every vehicle and returns the send times of the messages as
+    # (time, vehicle index, link, crc) through the results queue
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in range(vehicles)]
+    http = httplib.HTTPConnection('localhost', http_port)
+    momsn = [0] * vehicles
+    frames = {}
+    sent = []
+    start = time.time()
+    t0 = events[0][0] if events else 0
+    for t, link, data in events:
+        if speed > 0:
+            delay = start + (t - t0) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        for i in range(vehicles):
+            if link == LTE:
+                key = (data, i)
+                frame = frames.get(key)
+                if frame is None:
+                    frame = frames[key] = with_sysid(data, i + 1)
+                sent.append((time.time(), i, LTE, zlib.crc32(frame)))
+                sockets[i].sendto(frame, ('localhost', lte_port))
+            else:
+                momsn[i] += 1
+                body = urllib.urlencode(dict(imei=IMEI_FORMAT % i, momsn=momsn[i], data=data.encode('hex'),
+                                             transmit_time=datetime.utcnow().strftime('%y-%m-%d %H:%M:%S')))
+                sent.append((time.time(), i, SATCOM, zlib.crc32(data)))
+                http.request('POST', '/', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+                http.getresponse().read()
+    for sock in sockets:
+        sock.close()
+    http.close()
+    results.put(sent)
+
+
+def write_config(directory, args):
+    config = ConfigParser.RawConfigParser()
+    config.read(os.path.join(os.path.dirname(RELAY), 'relay.cfg'))
+    config.set('mqtt', 'hostname', 'localhost')
+    config.set('mqtt', 'port', str(args.mqtt_port))
+    config.set('lte', 'target_port', str(args.lte_port))
+    config.set('lte', 'receive_buffer', str(args.receive_buffer))
+    config.set('iridium', 'gateway', 'rock7')
+    config.set('iridium', 'local_port', str(args.http_port))
+    # MT messages are not replayed, the url only needs to be valid
+    config.set('iridium', 'url', 'http://localhost:1')
+    config.set('recorder', 'enabled', str(args.record).lower())
+    config.set('envelope', 'window', str(args.envelope_window))
+    for i in range(args.vehicles):
+        section = 'vehicle sim%d' % (i + 1)
+        config.add_section(section)
+        config.set(section, 'sysid', str(i + 1))
+        config.set(section, 'imei', IMEI_FORMAT % i)
+    with open(os.path.join(directory, 'relay.cfg'), 'w') as f:
+        config.write(f)
+
+    credentials = ConfigParser.RawConfigParser()
+    credentials.add_section('mqtt')
+    credentials.set('mqtt', 'user', 'replay')
+    credentials.set('mqtt', 'password', 'replay')
+    credentials.add_section('rockblock')
+    credentials.set('rockblock', 'imei', IMEI_FORMAT % 0)
+    credentials.set('rockblock', 'username', 'replay')
+    credentials.set('rockblock', 'password', 'replay')
+    with open(os.path.join(directory, 'credentials.cfg'), 'w') as f:
+        credentials.write(f)
+
+
+def udp_drops(port):
+    # datagrams dropped by the kernel on the UDP sockets bound to the port, e.g. because their receive
+    # buffer was full
+    drops = 0
+    with open('/proc/net/udp') as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if int(fields[1].split(':')[1], 16) == port:
+                drops += int(fields[-1])
+    return drops
+
+
+def process_usage(pid):
+    # returns (CPU seconds, RSS bytes) of a process
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = float(int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open('/proc/%d/statm' % pid) as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+
+def wait_for_port(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 0.1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p * len(values)))] if values else float('nan')
+
+
+class Subscriber:
+    # records the receive time of the relayed messages as (time, vehicle index, link, crc)
+    def __init__(self, port):
+        self.received = []
+        self.__client = mqtt.Client()
+        self.__client.on_connect = self.__on_connect
+        self.__client.on_message = self.__on_message
+        self.__client.connect('localhost', port)
+
+    def __on_connect(self, client, userdata, flags, rc):
+        client.subscribe([('telem/+/' + LTE, 0), ('telem/+/' + LTE_ENVELOPE, 0), ('telem/+/' + SATCOM, 0)])
+
+    def __on_message(self, client, userdata, msg):
+        name, link = msg.topic.split('/')[1:]
+        if not name.startswith('sim') or not msg.payload:
+            return
+        received = time.time()
+        if link == LTE_ENVELOPE:
+            for data in envelope.decode(msg.payload):
+                self.received.append((received, int(name[3:]) - 1, LTE, zlib.crc32(data)))
+        else:
+            self.received.append((received, int(name[3:]) - 1, link, zlib.crc32(msg.payload)))
+
+    def start(self):
+        self.__client.loop_start()
+
+    def stop(self):
+        self.__client.disconnect()
+        self.__client.loop_stop()
+
+
+def evaluate(sent, received, link):
+    # matches the received messages with the sent ones in order and returns the statistics of the link
+    pending = collections.defaultdict(collections.deque)
+    for t, i, l, crc in sent:
+        if l == link:
+            pending[(i, crc)].append(t)
+    latencies = []
+    times = []
+    for t, i, l, crc in received:
+        if l == link and pending[(i, crc)]:
+            latencies.append(t - pending[(i, crc)].popleft())
+            times.append(t)
+    latencies.sort()
+    sent_times = [t for t, i, l, crc in sent if l == link]
+    duration = times[-1] - times[0] if len(times) > 1 else 0
+    return dict(sent=len(sent_times), received=len(latencies),
+                rate=len(times) / duration if duration > 0 else 0,
+                p50=percentile(latencies, 0.5), p90=percentile(latencies, 0.9),
+                p99=percentile(latencies, 0.99), max=latencies[-1] if latencies else float('nan'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays tlogs and RockBLOCK csv exports into relay.py and measures its performance.')
+    parser.add_argument('-f', dest='filenames', action='append', required=True, help='tlog (.tlog, .tlog.gz) or RockBLOCK csv (.csv) to replay, can be repeated')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier, 0 replays as fast as possible')
+    parser.add_argument('--vehicles', type=int, default=1, help='Number of vehicles replaying the traffic')
+    parser.add_argument('--sysid', type=int, default=None, help='System id of the plane in the tlogs, default is the most frequent one')
+    parser.add_argument('--envelope-window', type=float, default=0, help='Batch the LTE datagrams into envelopes for this time [s]')
+    parser.add_argument('--record', action='store_true', help='Keep the tlog recorder of the relay enabled')
+    parser.add_argument('--mqtt-port', type=int, default=31883, help='Port of the stub MQTT broker')
+    parser.add_argument('--lte-port', type=int, default=30200, help='LTE UDP port of the relay')
+    parser.add_argument('--receive-buffer', type=int, default=8388608,
+                        help='Receive buffer of the LTE socket of the relay [bytes], limited by net.core.rmem_max')
+    parser.add_argument('--http-port', type=int, default=45779, help='Rock7 webhook port of the relay')
+    parser.add_argument('--json', dest='json_file', default=None, help='Write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory of the relay')
+    args = parser.parse_args()
+
+    events = load_events(args.filenames, args.sysid)
+    if not events:
+        print 'Nothing to replay'
+        return
+    print 'Replaying %d messages over %.0f s for %d vehicle(s) at %gx speed' % (
+        len(events), events[-1][0] - events[0][0], args.vehicles, args.speed)
+
+    directory = tempfile.mkdtemp(prefix='relay_replay_')
+    write_config(directory, args)
+    broker = multiprocessing.Process(target=mqtt_stub_broker.run, args=(args.mqtt_port,))
+    broker.start()
+    wait_for_port(args.mqtt_port, 5)
+    with open(os.path.join(directory, 'relay.out'), 'w') as log:
+        relay_process = subprocess.Popen([sys.executable, os.path.abspath(RELAY)], cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_port(args.http_port, 10):
+            print 'The relay did not start, see %s' % os.path.join(directory, 'relay.out')
+            args.keep = True
+            return
+        subscriber = Subscriber(args.mqtt_port)
+        subscriber.start()
+        time.sleep(1.0)
+
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=sender, args=(events, args.vehicles, args.speed, args.lte_port, args.http_port, results))
+        cpu_start = process_usage(relay_process.pid)[0]
+        drops_start = udp_drops(args.lte_port)
+        start = time.time()
+        process.start()
+        max_rss = 0
+        sent = None
+        # sample the relay until the sender is done and nothing arrived for two seconds
+        while True:
+            time.sleep(0.2)
+            cpu, rss = process_usage(relay_process.pid)
+            max_rss = max(max_rss, rss)
+            if sent is None and not results.empty():
+                sent = results.get()
+            last = subscriber.received[-1][0] if subscriber.received else start
+            if sent is not None and time.time() - max(last, sent[-1][0] if sent else start) > 2.0:
+                break
+        process.join()
+        duration = time.time() - start
+        kernel_drops = udp_drops(args.lte_port) - drops_start
+        subscriber.stop()
+    finally:
+        relay_process.send_signal(signal.SIGINT)
+        relay_process.wait()
+        broker.terminate()
+        broker.join()
+        if args.keep:
+            print 'Relay working directory: %s' % directory
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    summary = dict(messages=len(events), vehicles=args.vehicles, speed=args.speed,
+                   cpu_seconds=cpu - cpu_start, cpu_percent=100.0 * (cpu - cpu_start) / duration, max_rss=max_rss)
+    for link in [LTE, SATCOM]:
+        stats = evaluate(sent, subscriber.received, link)
+        summary[link] = stats
+        if stats['sent']:
+            print '%-17s received %d/%d, %.0f messages/s, latency p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms' % (
+                link, stats['received'], stats['sent'], stats['rate'],
+                1e3 * stats['p50'], 1e3 * stats['p90'], 1e3 * stats['p99'], 1e3 * stats['max'])
+    # datagrams which never reached the relay are not lost by it
+    summary[LTE]['kernel_drops'] = kernel_drops
+    if summary[LTE]['sent']:
+        print '%-17s %d dropped by the kernel (receive buffer full), %d lost by the relay' % (
+            LTE, kernel_drops, summary[LTE]['sent'] - summary[LTE]['received'] - kernel_drops)
+    print 'relay: %.1f s CPU (%.0f%%), max RSS %.1f MB' % (summary['cpu_seconds'], summary['cpu_percent'], max_rss / 1e6)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+from datetime import datetime
+import journal
+
+
+def format_record(record):
+    line = '%s %-14s %-6s %-16s %6d bytes' % (datetime.utcfromtimestamp(record.time).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                                             record.event, record.link, record.vehicle, record.size)
+    if record.value:
+        line += ' #%d' % record.value
+    if record.reference:
+        line += ' after %.3fs' % (record.time - record.reference)
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the records of journal files written by relay.py and udp2mqtt.py.')
+    parser.add_argument('-f', dest='filenames', action='append', required=True, help='Filename of a journal, can be repeated')
+    parser.add_argument('-e', '--event', action='append', help='Only print this event, can be repeated')
+    parser.add_argument('-v', '--vehicle', help='Only print the records of this vehicle')
+    parser.add_argument('-s', '--summary', action='store_true',
+                        help='Print the number of messages and bytes per event, link and vehicle instead of the records')
+    args = parser.parse_args()
+
+    # sampled events count for the number of events they represent
+    counts = collections.defaultdict(lambda: [0, 0])
+    for filename in args.filenames:
+        header, records = journal.read(filename)
+        for record in records:
+            if args.event and record.event not in args.event:
+                continue
+            if args.vehicle is not None and record.vehicle != args.vehicle:
+                continue
+            if args.summary:
+                rate = header['sampling'][record.event]
+                count = counts[(record.event, record.link, record.vehicle)]
+                # the LTE datagrams received at once are journaled in one record
+                count[0] += rate * (record.value if record.event == 'lte_received' else 1)
+                count[1] += rate * record.size
+            else:
+                print format_record(record)
+
+    if args.summary:
+        for (event, link, vehicle), (messages, size) in sorted(counts.items()):
+            print '%-14s %-6s %-16s %10d messages %12d bytes' % (event, link, vehicle, messages, size)
+
+
+if __name__ == '__main__':
+    main()
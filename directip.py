@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import logging
+import struct
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+import tornado.tcpserver
+
+LOGGER = logging.getLogger(__name__)
+
+# Iridium Short Burst Data DirectIP, see the Iridium SBD Developers Guide.
+# A message is the protocol revision, the length of the following information elements (IE)
+# and the IEs, each made of an id, the length of the IE data and the data.
+PROTOCOL_REVISION = 1
+MESSAGE_HEADER = struct.Struct('>BH')
+IE_HEADER = struct.Struct('>BH')
+
+MO_HEADER_IE = 0x01
+MO_PAYLOAD_IE = 0x02
+MO_LOCATION_IE = 0x03
+MO_CONFIRMATION_IE = 0x05
+MT_HEADER_IE = 0x41
+MT_PAYLOAD_IE = 0x42
+MT_CONFIRMATION_IE = 0x44
+MT_PRIORITY_IE = 0x46
+
+# autoId, imei, session status, momsn, mtmsn, time of session
+MO_HEADER = struct.Struct('>I15sBHHI')
+# unique client message id, imei, disposition flags
+MT_HEADER = struct.Struct('>I15sH')
+# unique client message id, imei, autoId, message status
+MT_CONFIRMATION = struct.Struct('>I15sIh')
+
+IMEI_LENGTH = 15
+MT_PAYLOAD_MAX_LENGTH = 1890
+
+
+class DirectIpError(Exception):
+    pass
+
+
+def parse_ies(message):
+    # splits the IEs of a message without copying, the message must not include the message header
+    view = memoryview(message)
+    ies = {}
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < IE_HEADER.size:
+            raise DirectIpError('Truncated IE header at offset {0}'.format(offset))
+        ie_id, ie_length = IE_HEADER.unpack_from(message, offset)
+        offset += IE_HEADER.size
+        if ie_length > len(view) - offset:
+            raise DirectIpError('IE 0x{0:02x} length bigger than the remaining data ({1} > {2})'.format(ie_id, ie_length, len(view) - offset))
+        ies[ie_id] = view[offset:offset + ie_length]
+        offset += ie_length
+    return ies
+
+
+def parse_mo_message(message):
+    # returns (imei, momsn, session status, time of session, payload) of an MO message
+    ies = parse_ies(message)
+    header = ies.get(MO_HEADER_IE)
+    if header is None or len(header) != MO_HEADER.size:
+        raise DirectIpError('MO message without a valid MO header IE')
+    auto_id, imei, status, momsn, mtmsn, session_time = MO_HEADER.unpack(header.tobytes())
+    payload = ies.get(MO_PAYLOAD_IE)
+    return imei, momsn, status, session_time, payload.tobytes() if payload is not None else ''
+
+
+def parse_mt_confirmation(message):
+    # returns (unique client message id, imei, message status) of an MT confirmation
+    ies = parse_ies(message)
+    confirmation = ies.get(MT_CONFIRMATION_IE)
+    if confirmation is None or len(confirmation) != MT_CONFIRMATION.size:
+        raise DirectIpError('MT confirmation without a valid MT confirmation IE')
+    msg_id, imei, auto_id, status = MT_CONFIRMATION.unpack(confirmation.tobytes())
+    return msg_id, imei, status
+
+
+class MtEncoder:
+    # message header, MT header IE and MT payload IE header, the message id and lengths are filled in per message
+    PREFIX_LENGTH = MESSAGE_HEADER.size + IE_HEADER.size + MT_HEADER.size + IE_HEADER.size
+
+    def __init__(self):
+        self.__templates = {}
+
+    def __template(self, imei):
+        template = self.__templates.get(imei)
+        if template is None:
+            if len(imei) != IMEI_LENGTH:
+                raise DirectIpError('Invalid imei ' + imei)
+            template = bytearray(self.PREFIX_LENGTH)
+            offset = MESSAGE_HEADER.size
+            IE_HEADER.pack_into(template, offset, MT_HEADER_IE, MT_HEADER.size)
+            offset += IE_HEADER.size
+            MT_HEADER.pack_into(template, offset, 0, imei, 0)
+            self.__templates[imei] = template
+        return template
+
+    def encode(self, imei, msg_id, payload):
+        if len(payload) > MT_PAYLOAD_MAX_LENGTH:
+            raise DirectIpError('MT payload too long ({0} bytes)'.format(len(payload)))
+        message = bytearray(self.PREFIX_LENGTH + len(payload))
+        message[:self.PREFIX_LENGTH] = self.__template(imei)
+        MESSAGE_HEADER.pack_into(message, 0, PROTOCOL_REVISION, len(message) - MESSAGE_HEADER.size)
+        struct.pack_into('>I', message, MESSAGE_HEADER.size + IE_HEADER.size, msg_id & 0xffffffff)
+        IE_HEADER.pack_into(message, self.PREFIX_LENGTH - IE_HEADER.size, MT_PAYLOAD_IE, len(payload))
+        message[self.PREFIX_LENGTH:] = payload
+        return message
+
+
+def encode_mo_confirmation(success):
+    message = bytearray(MESSAGE_HEADER.size + IE_HEADER.size + 1)
+    MESSAGE_HEADER.pack_into(message, 0, PROTOCOL_REVISION, IE_HEADER.size + 1)
+    IE_HEADER.pack_into(message, MESSAGE_HEADER.size, MO_CONFIRMATION_IE, 1)
+    message[-1] = 1 if success else 0
+    return bytes(message)
+
+
+def read_message(stream, callback):
+    # reads one message from the stream and calls the callback with the IEs of it, or with None if the
+    # connection was closed before. Data received before the connection was closed is still read.
+    ioloop = tornado.ioloop.IOLoop.current()
+
+    def read_bytes(length, on_read):
+        try:
+            ioloop.add_future(stream.read_bytes(length), on_read)
+        except tornado.iostream.StreamClosedError:
+            callback(None)
+
+    def on_header(future):
+        if future.exception() is not None:
+            callback(None)
+            return
+        revision, length = MESSAGE_HEADER.unpack(future.result())
+        if revision != PROTOCOL_REVISION:
+            LOGGER.warn('Closing DirectIP connection, unsupported protocol revision %d', revision)
+            stream.close()
+            callback(None)
+            return
+        read_bytes(length, on_body)
+
+    def on_body(future):
+        callback(future.result() if future.exception() is None else None)
+
+    read_bytes(MESSAGE_HEADER.size, on_header)
+
+
+def write_message(stream, message):
+    try:
+        stream.write(message)
+    except tornado.iostream.StreamClosedError:
+        pass
+
+
+class MoServer(tornado.tcpserver.TCPServer):
+    # the Iridium gateway opens a connection for every MO message
+    def __init__(self, confirm):
+        tornado.tcpserver.TCPServer.__init__(self)
+        self.__confirm = confirm
+        self.on_message_callback = None
+
+    def handle_stream(self, stream, address):
+        def on_message(message):
+            if message is None:
+                stream.close()
+                return
+            try:
+                imei, momsn, status, session_time, payload = parse_mo_message(message)
+            except (DirectIpError, struct.error) as e:
+                LOGGER.warn('Invalid MO message from %s: %s', address[0], e)
+                if self.__confirm:
+                    write_message(stream, encode_mo_confirmation(False))
+                stream.close()
+                return
+
+            self.on_message_callback(imei, momsn, status, session_time, payload)
+            if self.__confirm:
+                write_message(stream, encode_mo_confirmation(True))
+            read_message(stream, on_message)
+
+        read_message(stream, on_message)
+
+
+class MtClient:
+    # opens a connection to the Iridium gateway for every MT message
+    def __init__(self, host, port, timeout):
+        self.__host = host
+        self.__port = port
+        self.__timeout = timeout
+        self.__encoder = MtEncoder()
+        self.__tcp_client = tornado.tcpclient.TCPClient()
+        self.__ioloop = tornado.ioloop.IOLoop.current()
+
+    def send(self, imei, msg_id, payload, callback):
+        # the callback is called with the message status of the confirmation, None if it failed
+        message = self.__encoder.encode(imei, msg_id, payload)
+        state = dict(stream=None, done=False)
+
+        def finish(status):
+            if state['done']:
+                return
+            state['done'] = True
+            self.__ioloop.remove_timeout(timer)
+            if state['stream'] is not None:
+                state['stream'].close()
+            callback(status)
+
+        def on_confirmation(data):
+            if data is None:
+                LOGGER.warn('DirectIP gateway closed the connection without MT confirmation')
+                finish(None)
+                return
+            try:
+                confirmed_id, confirmed_imei, status = parse_mt_confirmation(data)
+            except (DirectIpError, struct.error) as e:
+                LOGGER.warn('Invalid MT confirmation: %s', e)
+                finish(None)
+                return
+            if confirmed_id != msg_id & 0xffffffff or confirmed_imei != imei:
+                LOGGER.warn('MT confirmation for message %d of imei %s received for message %d of imei %s',
+                            confirmed_id, confirmed_imei, msg_id, imei)
+                finish(None)
+                return
+            finish(status)
+
+        def on_connected(future):
+            if state['done']:
+                if future.exception() is None:
+                    future.result().close()
+                return
+            if future.exception() is not None:
+                LOGGER.warn('Connecting to the DirectIP gateway failed: %s', future.exception())
+                finish(None)
+                return
+            stream = state['stream'] = future.result()
+            write_message(stream, message)
+            read_message(stream, on_confirmation)
+
+        timer = self.__ioloop.call_later(self.__timeout, lambda: finish(None))
+        self.__ioloop.add_future(self.__tcp_client.connect(self.__host, self.__port), on_connected)
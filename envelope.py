@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import struct
+import zlib
+
+# Several LTE datagrams published as one MQTT message: the format version followed by the
+# zlib compressed datagrams, each prefixed with its length.
+VERSION = 1
+VERSION_HEADER = struct.Struct('>B')
+LENGTH_PREFIX = struct.Struct('>H')
+MAX_DATAGRAM_LENGTH = 0xffff
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def encode(datagrams, level=6):
+    parts = []
+    for datagram in datagrams:
+        if len(datagram) > MAX_DATAGRAM_LENGTH:
+            raise EnvelopeError('Datagram too long ({0} bytes)'.format(len(datagram)))
+        parts.append(LENGTH_PREFIX.pack(len(datagram)))
+        parts.append(datagram)
+    return VERSION_HEADER.pack(VERSION) + zlib.compress(''.join(parts), level)
+
+
+def decode(data):
+    # returns the datagrams of an envelope in the order they were added
+    if len(data) < VERSION_HEADER.size:
+        raise EnvelopeError('Empty envelope')
+    version = VERSION_HEADER.unpack_from(data)[0]
+    if version != VERSION:
+        raise EnvelopeError('Unsupported envelope version {0}'.format(version))
+    try:
+        payload = zlib.decompress(data[VERSION_HEADER.size:])
+    except zlib.error as e:
+        raise EnvelopeError('Invalid envelope: {0}'.format(e))
+
+    datagrams = []
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < LENGTH_PREFIX.size:
+            raise EnvelopeError('Truncated length prefix at offset {0}'.format(offset))
+        length = LENGTH_PREFIX.unpack_from(payload, offset)[0]
+        offset += LENGTH_PREFIX.size
+        if length > len(payload) - offset:
+            raise EnvelopeError('Datagram length bigger than the remaining data ({0} > {1})'.format(length, len(payload) - offset))
+        datagrams.append(payload[offset:offset + length])
+        offset += length
+    return datagrams
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import collections
+import json
+import logging
+import os
+import struct
+from threading import Thread, Event
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# A journal file starts with the magic and the length of a JSON header naming the events and links and
+# listing the sampling rates. It is followed by records of a fixed size: the time of the event, the time
+# of an earlier related event (0 if there is none), the event, the link, the vehicle name (zero padded),
+# the size of the message and a value depending on the event.
+MAGIC = 'SCJ1'
+HEADER_LENGTH = struct.Struct('>I')
+RECORD = struct.Struct('>ddBB16sIi')
+SUFFIX = '.journal'
+
+# events, the value of the record is noted if it is used
+LTE_RECEIVED = 0     # LTE datagrams of a vehicle received at once from the plane, value: number of datagrams
+LTE_SENT = 1         # LTE datagram sent to the plane
+UDP_RECEIVED = 2     # datagram received from the ground station
+UDP_SENT = 3         # datagram sent to the ground station
+MQTT_RECEIVED = 4    # value: number of datagrams for envelopes
+MQTT_PUBLISHED = 5   # value: MQTT message id
+MQTT_CONFIRMED = 6   # value: MQTT message id, reference: time of the publish
+MO_RECEIVED = 7      # value: momsn
+MT_SENT = 8          # value: message index
+MT_DELIVERED = 9     # value: message index, reference: time the delivery started
+EVENTS = ['lte_received', 'lte_sent', 'udp_received', 'udp_sent', 'mqtt_received', 'mqtt_published', 'mqtt_confirmed',
+          'mo_received', 'mt_sent', 'mt_delivered']
+
+NO_LINK = 0
+LTE = 1
+SATCOM = 2
+LINKS = ['', 'lte', 'satcom']
+
+Record = collections.namedtuple('Record', 'time reference event link vehicle size value')
+
+
+def parse_sampling(text):
+    # 'lte_received:100, mqtt_published:10' to a dict, 0 disables an event
+    sampling = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        name, rate = item.split(':')
+        if name.strip() not in EVENTS:
+            raise ValueError('Unknown journal event ' + name.strip())
+        sampling[name.strip()] = int(rate)
+    return sampling
+
+
+class Journal:
+    # Records the events of the message paths without formatting and without file I/O on the caller,
+    # the records are queued and written by a separate thread. An event with a sampling rate of n is
+    # recorded every nth time. Nothing is recorded until the journal is started.
+    def __init__(self):
+        self.__rates = [0] * len(EVENTS)
+        self.__counts = [0] * len(EVENTS)
+        self.__pending = collections.deque()
+        self.__queue_size = 0
+        self.__directory = None
+        self.__prefix = None
+        self.__segment_size = 0
+        self.__max_segments = 0
+        self.__flush_interval = 1.0
+        self.__header = None
+        self.__file = None
+        self.__file_size = 0
+        self.__wakeup = Event()
+        self.__stopping = False
+        self.__thread = None
+        self.dropped = 0
+
+    def record(self, event, link, vehicle='', size=0, value=0, reference=0.0):
+        rate = self.__rates[event]
+        if rate != 1:
+            if rate == 0:
+                return
+            self.__counts[event] += 1
+            if self.__counts[event] % rate:
+                return
+        if len(self.__pending) >= self.__queue_size:
+            self.dropped += 1
+            return
+        self.__pending.append((time.time(), reference, event, link, vehicle, size, value))
+
+    def __open(self):
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+        base = os.path.join(self.__directory, self.__prefix + time.strftime('_%Y-%m-%d_%H-%M-%S', time.gmtime()))
+        filename = base + SUFFIX
+        suffix = 1
+        while os.path.exists(filename):
+            filename = '%s_%d%s' % (base, suffix, SUFFIX)
+            suffix += 1
+        self.__file = open(filename, 'wb')
+        self.__file.write(MAGIC + HEADER_LENGTH.pack(len(self.__header)) + self.__header)
+        self.__file_size = len(MAGIC) + HEADER_LENGTH.size + len(self.__header)
+        self.__prune()
+
+    def __prune(self):
+        # only the newest max_segments files of this prefix are kept, their names sort by their time
+        if self.__max_segments <= 0:
+            return
+        start = self.__prefix + '_'
+        segments = sorted(name for name in os.listdir(self.__directory) if name.startswith(start) and
+                          name[len(start):len(start) + 1].isdigit() and name.endswith(SUFFIX))
+        for name in segments[:-self.__max_segments]:
+            try:
+                os.remove(os.path.join(self.__directory, name))
+            except OSError as e:
+                LOGGER.warn('Failed to remove the journal %s: %s', name, e)
+
+    def __write(self):
+        records = []
+        while self.__pending:
+            created, reference, event, link, vehicle, size, value = self.__pending.popleft()
+            records.append(RECORD.pack(created, reference, event, link, vehicle, size, value))
+        if not records:
+            return
+        if self.__file is None or self.__file_size >= self.__segment_size:
+            if self.__file is not None:
+                self.__file.close()
+            self.__open()
+        data = ''.join(records)
+        self.__file.write(data)
+        self.__file.flush()
+        self.__file_size += len(data)
+
+    def __run(self):
+        while not self.__stopping:
+            self.__wakeup.wait(self.__flush_interval)
+            try:
+                self.__write()
+            except (IOError, OSError, struct.error) as e:
+                LOGGER.error('Failed to write the journal: %s', e)
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def start(self, directory, prefix, segment_size, max_segments, queue_size, flush_interval, sampling):
+        self.__directory = directory
+        self.__prefix = prefix
+        self.__segment_size = segment_size
+        self.__max_segments = max_segments
+        self.__queue_size = queue_size
+        self.__flush_interval = flush_interval
+        rates = [sampling.get(name, 1) for name in EVENTS]
+        self.__header = json.dumps(dict(events=EVENTS, links=LINKS, sampling=dict(zip(EVENTS, rates))))
+        self.__stopping = False
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        self.__rates = rates
+
+    def stop(self):
+        # writes the queued records before returning
+        if self.__thread is None:
+            return
+        self.__rates = [0] * len(EVENTS)
+        self.__stopping = True
+        self.__wakeup.set()
+        self.__thread.join()
+        self.__thread = None
+
+
+def read(filename):
+    # returns the header and a generator of the records of a journal file
+    f = open(filename, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError(filename + ' is not a journal')
+    length = HEADER_LENGTH.unpack(f.read(HEADER_LENGTH.size))[0]
+    header = json.loads(f.read(length))
+    events = header['events']
+    links = header['links']
+
+    def records():
+        with f:
+            while True:
+                data = f.read(RECORD.size)
+                if len(data) < RECORD.size:
+                    break
+                created, reference, event, link, vehicle, size, value = RECORD.unpack(data)
+                yield Record(created, reference, events[event], links[link], vehicle.rstrip('\0'), size, value)
+
+    return header, records()
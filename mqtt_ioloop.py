@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import logging
+import paho.mqtt.client as mqtt
+import socket
+from threading import Thread
+import tornado.ioloop
+
+LOGGER = logging.getLogger(__name__)
+
+# timeout of connecting to the MQTT broker [s]
+CONNECT_TIMEOUT = 5
+
+
+class MqttClient(mqtt.Client):
+    # The network traffic of the client is handled on the IOLoop instead of the paho thread, which does
+    # not survive a failed reconnect, so that the client reconnects after a broker outage. paho connects
+    # to the broker blocking in reconnect(), the socket is connected in a thread beforehand and handed
+    # over, so that an unreachable broker does not stall the IOLoop.
+    def __init__(self, host, port, client_id=''):
+        mqtt.Client.__init__(self, client_id)
+        self.__host = host
+        self.__port = port
+        self.__ioloop = tornado.ioloop.IOLoop.current()
+        self.__connected_socket = None
+        self.__connecting = False
+        self.__stopped = False
+        self.__misc_scheduler = None
+        self.on_socket_open = self.__on_socket_open
+        self.on_socket_close = self.__on_socket_close
+        self.on_socket_register_write = self.__on_socket_register_write
+        self.on_socket_unregister_write = self.__on_socket_unregister_write
+
+    def _create_socket_connection(self):
+        sock = self.__connected_socket
+        self.__connected_socket = None
+        if sock is None:
+            return mqtt.Client._create_socket_connection(self)
+        return sock
+
+    def __loop_misc(self):
+        # keepalive and reconnect once per second
+        if self.loop_misc() == mqtt.MQTT_ERR_NO_CONN and not self.__connecting:
+            self.__connecting = True
+            thread = Thread(target=self.__open_connection)
+            thread.daemon = True
+            thread.start()
+
+    def __open_connection(self):
+        # runs in its own thread, resolving the broker and connecting to it blocks
+        try:
+            sock = socket.create_connection((self.__host, self.__port), CONNECT_TIMEOUT)
+        except socket.error as e:
+            sock = e
+        self.__ioloop.add_callback(self.__on_connection_opened, sock)
+
+    def __on_connection_opened(self, sock):
+        self.__connecting = False
+        if isinstance(sock, socket.error):
+            LOGGER.warn('Connecting to the broker failed, retrying in 1 second: ' + str(sock))
+            return
+        if self.__stopped:
+            sock.close()
+            return
+
+        self.__connected_socket = sock
+        try:
+            self.reconnect()
+        except socket.error as e:
+            LOGGER.warn('Connecting to the broker failed, retrying in 1 second: ' + str(e))
+
+    def __on_socket_open(self, client, userdata, sock):
+        self.__ioloop.add_handler(sock, self.__on_socket_event, tornado.ioloop.IOLoop.READ)
+
+    def __on_socket_close(self, client, userdata, sock):
+        self.__ioloop.remove_handler(sock)
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        self.__ioloop.update_handler(sock, tornado.ioloop.IOLoop.READ | tornado.ioloop.IOLoop.WRITE)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        self.__ioloop.update_handler(sock, tornado.ioloop.IOLoop.READ)
+
+    def __on_socket_event(self, fd, events):
+        if events & tornado.ioloop.IOLoop.READ:
+            self.loop_read()
+        if events & tornado.ioloop.IOLoop.WRITE and self.socket() is not None:
+            self.loop_write()
+
+    def start(self):
+        self.connect_async(self.__host, self.__port)
+        self.__misc_scheduler = tornado.ioloop.PeriodicCallback(self.__loop_misc, 1000)
+        self.__misc_scheduler.start()
+        self.__loop_misc()
+
+    def stop(self):
+        self.__stopped = True
+        self.__misc_scheduler.stop()
+        self.disconnect()
+        # the IOLoop is not running anymore, flush the disconnect directly
+        if self.socket() is not None:
+            self.loop_write()
@@ -93,6 +93,54 @@ class MAVLink_header(object):
         return struct.pack('<BBBBBB', PROTOCOL_MARKER_V1, self.mlen, self.seq,
                            self.srcSystem, self.srcComponent, self.msgId)
 
+_frame_header_v1 = struct.Struct('<BBBBBB')
+_frame_header_v2 = struct.Struct('<BBBBBBBHB')
+
+def frame_header(buf, offset=0, end=None):
+    '''reads the header of the MAVLink1 or MAVLink2 frame at offset in buf
+    without checking the CRC or unpacking the payload. Returns
+    (frame length, msgId, srcSystem, srcComponent, payload offset, payload length,
+    seq) or None if buf[offset:end] does not start with a complete frame'''
+    if end is None:
+        end = len(buf)
+    available = end - offset
+    if available < HEADER_LEN_V1 + 2:
+        return None
+    (marker, mlen, seq, srcSystem, srcComponent, msgId) = _frame_header_v1.unpack_from(buf, offset)
+    if marker == PROTOCOL_MARKER_V1:
+        length = HEADER_LEN_V1 + mlen + 2
+        payload_offset = offset + HEADER_LEN_V1
+    elif marker == PROTOCOL_MARKER_V2 and available >= HEADER_LEN_V2 + 2:
+        (marker, mlen, incompat_flags, compat_flags, seq, srcSystem, srcComponent,
+         msgIdlow, msgIdhigh) = _frame_header_v2.unpack_from(buf, offset)
+        msgId = msgIdlow | (msgIdhigh << 16)
+        length = HEADER_LEN_V2 + mlen + 2
+        if incompat_flags & MAVLINK_IFLAG_SIGNED:
+            length += MAVLINK_SIGNATURE_BLOCK_LEN
+        payload_offset = offset + HEADER_LEN_V2
+    else:
+        return None
+    if length > available:
+        return None
+    return (length, msgId, srcSystem, srcComponent, payload_offset, mlen, seq)
+
+def frame_headers(buf, end=None):
+    '''walks the MAVLink1 and MAVLink2 frames in buf[:end] using frame_header,
+    yielding (frame offset, frame length, msgId, srcSystem, srcComponent,
+    payload offset, payload length, seq) for every frame. Bytes from which no
+    complete frame can be read end the walk and are yielded as one chunk
+    with msgId, srcSystem, srcComponent and seq set to None'''
+    if end is None:
+        end = len(buf)
+    offset = 0
+    while offset < end:
+        header = frame_header(buf, offset, end)
+        if header is None:
+            yield (offset, end - offset, None, None, None, offset, 0, None)
+            return
+        yield (offset,) + header
+        offset += header[0]
+
 class MAVLink_message(object):
     '''base MAVLink message class'''
     def __init__(self, msgId, name):
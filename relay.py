@@ -1,265 +1,2348 @@
 #!/usr/bin/env python
 
+import calendar
+import collections
+import bisect
 import ConfigParser
+import directip
+import envelope
+import errno
+import functools
+import gzip
+import heapq
+import journal
+import json
 import logging
-import paho.mqtt.client as mqtt
+import mqtt_ioloop
+import multiprocessing
+import os
+from pymavlink import mavlink
+import Queue
+import random
+import shutil
 import socket
-import sys
-from threading import Thread, Lock
+import spool
+import struct
+from threading import Thread
 import time
+import tornado.concurrent
+import tornado.gen
 import tornado.web
+import tornado.websocket
 import tornado.ioloop
 import tornado.httpclient
 import tornado.httputil
+import urlparse
+import zlib
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
 
 LOG_FORMAT = '%(levelname) -10s %(asctime)s %(name) -30s %(funcName) -35s %(lineno) -5d: %(message)s'
 LOGGER = logging.getLogger(__name__)
 
+# Rock7 charges one credit per started block of 50 bytes, MT messages are limited to 270 bytes
+CREDIT_BYTES = 50
+MT_MAX_LENGTH = 270
+
+# Rock7 errors which fail again on a retry: credentials, unknown imei, line rental, credit, bad, too long
+# or missing data. 99 is a system error of Rock7.
+ROCK7_PERMANENT_ERRORS = ['10', '11', '12', '13', '14', '15', '16']
+# DirectIP MT statuses which fail again on a retry: invalid or unknown imei, payload too big or missing,
+# protocol error, ring alerts disabled
+DIRECTIP_PERMANENT_ERRORS = [-1, -2, -3, -4, -7, -8]
+
+
+def credits(length):
+    return max(1, (length + CREDIT_BYTES - 1) // CREDIT_BYTES)
+
+
+MAVLINK_MSG_ID_SYSTEM_TIME = 2
+MAVLINK_MSG_ID_PARAM_VALUE = 22
+MAVLINK_MSG_ID_COMMAND_ACK = 77
+MAVLINK_MSG_ID_HIGH_LATENCY2 = 235
+
+
+def mavlink_frames(data):
+    # Splits a buffer into MAVLink v1/v2 frames, yielding (frame, msgid, payload). Bytes that cannot
+    # be framed are yielded as one chunk with msgid None.
+    for offset, length, msgid, sysid, compid, payload_offset, payload_length, seq in mavlink.frame_headers(data):
+        yield data[offset:offset + length], msgid, data[payload_offset:payload_offset + payload_length]
+
+
+def mavlink_msgid(data):
+    # message id of the first frame in the buffer
+    header = mavlink.frame_header(data)
+    return header[1] if header is not None else None
+
+
+def mavlink_has_ack(data):
+    # whether any frame in the buffer acknowledges a command or parameter sent to the plane
+    for header in mavlink.frame_headers(data):
+        if header[2] in (MAVLINK_MSG_ID_COMMAND_ACK, MAVLINK_MSG_ID_PARAM_VALUE):
+            return True
+    return False
+
+
+def mavlink_sysid(buf, length):
+    # buf is a bytearray holding a datagram of the given length
+    header = mavlink.frame_header(buf, 0, length)
+    return header[2] if header is not None else None
+
+
+# MAVLink v2 truncates trailing zeros of the payload
+def _unpack_payload(fmt, payload):
+    size = struct.calcsize(fmt)
+    if len(payload) < size:
+        payload += '\0' * (size - len(payload))
+    return struct.unpack_from(fmt, payload)
+
+
+class Metrics:
+    # name: (type, help)
+    DESCRIPTIONS = {
+        'relay_packets_total': ('counter', 'Messages relayed per link and direction'),
+        'relay_bytes_total': ('counter', 'Bytes relayed per link and direction'),
+        'relay_credits_total': ('counter', 'Rock7 credits consumed by MO and MT messages'),
+        'relay_mt_credits_saved_total': ('counter', 'Credits saved by packing MT payloads'),
+        'relay_mt_retries_total': ('counter', 'Failed MT posts to Rock7 which are retried'),
+        'relay_mt_dropped_total': ('counter', 'MT payloads dropped before the gateway accepted them'),
+        'relay_mo_duplicates_total': ('counter', 'Retried MO messages which were already relayed'),
+        'relay_mo_unconfirmed_total': ('counter', 'MO posts answered with an error because the broker did not confirm the message'),
+        'relay_mt_outbox_depth': ('gauge', 'MT messages waiting for delivery to Rock7'),
+        'relay_rock7_post_seconds': ('histogram', 'Duration of the MT posts to Rock7'),
+        'relay_rock7_phase_seconds': ('histogram', 'Duration of the phases of the MT posts to Rock7'),
+        'relay_rock7_connections_total': ('counter', 'MT posts to Rock7 by whether a connection was reused'),
+        'relay_directip_mt_seconds': ('histogram', 'Duration of the MT deliveries to the DirectIP gateway'),
+        'relay_mt_handoff_seconds': ('histogram', 'Time from queueing an MT message until Rock7 accepted it'),
+        'relay_mqtt_publish_seconds': ('histogram', 'Time until the broker confirmed a publish'),
+        'relay_latency_seconds': ('histogram', 'Latency of the messages from the plane per link and stage'),
+        'relay_vehicles_rejected_total': ('counter', 'Unknown vehicles not registered because of the limit or an invalid imei'),
+        'relay_vehicle_queued_bytes': ('gauge', 'Bytes queued for a vehicle'),
+        'relay_lte_session_active': ('gauge', 'Whether the address of the vehicle on the LTE link is known'),
+        'relay_lte_last_message_age_seconds': ('gauge', 'Time since the last LTE message from the vehicle'),
+        'relay_satcom_last_mo_age_seconds': ('gauge', 'Time since the last MO message from the vehicle'),
+        'relay_tlog_queue_depth': ('gauge', 'Messages waiting to be written to the tlogs'),
+        'relay_tlog_dropped_total': ('counter', 'Messages not recorded because the tlog queue was full'),
+        'relay_link_healthy': ('gauge', 'Whether the plane was heard recently on the link'),
+        'relay_link_mt_cancelled_total': ('counter', 'SatCom MT payloads dropped because they were acknowledged over LTE'),
+        'relay_link_credits_saved_total': ('counter', 'Credits saved by dropping SatCom MT payloads acknowledged over LTE'),
+        'relay_spool_bytes': ('gauge', 'Bytes of the messages spooled while the broker is not reachable'),
+        'relay_spool_dropped_total': ('counter', 'Spooled messages dropped because they expired or the spool was full'),
+        'relay_lte_lost_total': ('counter', 'MAVLink frames from the plane missing in the sequence numbers on LTE'),
+        'relay_lte_duplicates_total': ('counter', 'Duplicate MAVLink frames from the plane on LTE, datagrams of duplicates are dropped'),
+        'relay_lte_reordered_total': ('counter', 'MAVLink frames from the plane which arrived out of order on LTE'),
+        'relay_lte_envelopes_total': ('counter', 'LTE envelopes published'),
+        'relay_lte_envelope_datagrams_total': ('counter', 'LTE datagrams published in envelopes'),
+        'relay_lte_envelope_bytes_total': ('counter', 'Bytes of the LTE datagrams in envelopes before and after the compression'),
+        'relay_journal_dropped_total': ('counter', 'Journal records dropped because the journal queue was full'),
+        'relay_state_renders_total': ('counter', 'Vehicle state snapshots rendered for the state endpoint'),
+        'relay_state_deltas_total': ('counter', 'Changes of the vehicle state pushed to the WebSocket subscribers'),
+        'relay_state_deltas_dropped_total': ('counter', 'Changes of the vehicle state not sent to slow WebSocket subscribers'),
+        'relay_state_subscribers': ('gauge', 'WebSocket subscribers of the vehicle state'),
+    }
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0, 120.0, 300.0]
+
+    def __init__(self):
+        self.__counters = collections.defaultdict(float)
+        self.__histograms = {}
+        self.__gauge_callbacks = []
+        self.__remote = {}
+
+    # labels are tuples of (name, value) pairs so that they can be built once and reused
+    def inc(self, name, labels=(), value=1):
+        self.__counters[(name, labels)] += value
+
+    def observe(self, name, value, labels=()):
+        histogram = self.__histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.__histograms[(name, labels)] = [0] * len(self.BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def add_gauge_callback(self, callback):
+        # the callback returns a list of (name, labels, value) when the metrics are requested
+        self.__gauge_callbacks.append(callback)
+
+    def reset(self):
+        # a forked worker process starts without the metrics of its parent
+        self.__counters.clear()
+        self.__histograms.clear()
+        del self.__gauge_callbacks[:]
+        self.__remote.clear()
+
+    def __gauges(self):
+        gauges = []
+        for callback in self.__gauge_callbacks:
+            gauges.extend(callback())
+        return gauges
+
+    def snapshot(self):
+        return self.__counters.items(), self.__gauges(), self.__histograms.items()
+
+    def set_remote(self, extra_labels, snapshot):
+        # the snapshot of a worker process is rendered with the extra labels identifying the worker
+        self.__remote[extra_labels] = snapshot
+
+    @staticmethod
+    def __format_labels(labels, extra=()):
+        labels = labels + extra
+        if not labels:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render(self):
+        samples = collections.defaultdict(list)
+        sources = [((),) + self.snapshot()]
+        sources.extend((extra,) + snapshot for extra, snapshot in self.__remote.items())
+        for extra, counters, gauges, histograms in sources:
+            for (name, labels), value in counters:
+                samples[name].append((name, labels + extra, value))
+            for name, labels, value in gauges:
+                samples[name].append((name, labels + extra, value))
+            for (name, labels), histogram in histograms:
+                self.__histogram_samples(samples[name], name, labels + extra, histogram)
+
+        lines = []
+        for name in sorted(samples):
+            metric_type, description = self.DESCRIPTIONS[name]
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for sample_name, labels, value in samples[name]:
+                lines.append('%s%s %s' % (sample_name, self.__format_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def __histogram_samples(self, samples, name, labels, histogram):
+        count = 0
+        for bound, bucket in zip(self.BUCKETS, histogram):
+            count += bucket
+            samples.append((name + '_bucket', labels + (('le', repr(bound)),), count))
+        samples.append((name + '_bucket', labels + (('le', '+Inf'),), histogram[-1]))
+        samples.append((name + '_sum', labels, histogram[-2]))
+        samples.append((name + '_count', labels, histogram[-1]))
+
+
+METRICS = Metrics()
+JOURNAL = journal.Journal()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(METRICS.render())
+
+
+class Vehicle:
+    def __init__(self, name, sysid, imei, max_queued_bytes):
+        self.name = name
+        self.sysid = sysid
+        self.imei = imei
+        self.lte_address = None
+        self.lte_last_seen = None
+        self.mo_last_seen = None
+        self.scheduler = None
+        self.__topics = {}
+        self.__labels = {}
+        self.__max_queued_bytes = max_queued_bytes
+        self.queued_bytes = 0
+        self.rejected_counter = 0
+
+    def topic(self, link):
+        topic = self.__topics.get(link)
+        if topic is None:
+            # the vehicle without a name uses the topics of the single vehicle setup
+            if self.name:
+                topic = 'telem/' + self.name + '/' + link
+            else:
+                topic = 'telem/' + link
+            self.__topics[link] = topic
+        return topic
+
+    def labels(self, link, direction=None):
+        labels = self.__labels.get((link, direction))
+        if labels is None:
+            labels = (('vehicle', self.name), ('link', link))
+            if direction is not None:
+                labels += (('direction', direction),)
+            self.__labels[(link, direction)] = labels
+        return labels
+
+    def reserve(self, length):
+        if self.queued_bytes + length > self.__max_queued_bytes:
+            self.rejected_counter += 1
+            return False
+        self.queued_bytes += length
+        return True
+
+    def release(self, length):
+        self.queued_bytes -= length
+
+
+class VehicleRegistry:
+    def __init__(self, max_queued_bytes, auto_register, max_auto_registered):
+        self.__max_queued_bytes = max_queued_bytes
+        self.__auto_register = auto_register
+        self.__max_auto_registered = max_auto_registered
+        self.__auto_registered = 0
+        self.__by_name = {}
+        self.__by_sysid = {}
+        self.__by_imei = {}
+        self.__default = None
+        self.on_vehicle_added_callback = None
+        METRICS.add_gauge_callback(self.__gauges)
+
+    def __gauges(self):
+        now = time.time()
+        gauges = []
+        for vehicle in self.__by_name.itervalues():
+            labels = (('vehicle', vehicle.name),)
+            gauges.append(('relay_vehicle_queued_bytes', labels, vehicle.queued_bytes))
+            gauges.append(('relay_lte_session_active', labels, 1 if vehicle.lte_address is not None else 0))
+            if vehicle.lte_last_seen is not None:
+                gauges.append(('relay_lte_last_message_age_seconds', labels, now - vehicle.lte_last_seen))
+            if vehicle.mo_last_seen is not None:
+                gauges.append(('relay_satcom_last_mo_age_seconds', labels, now - vehicle.mo_last_seen))
+        return gauges
+
+    def add(self, name, sysid, imei, default=False):
+        vehicle = Vehicle(name, sysid, imei, self.__max_queued_bytes)
+        self.__by_name[name] = vehicle
+        if sysid is not None:
+            self.__by_sysid[sysid] = vehicle
+        if imei is not None:
+            self.__by_imei[imei] = vehicle
+        if default:
+            self.__default = vehicle
+        LOGGER.warn('Serving vehicle "%s" (sysid %s, imei %s)', name, sysid, imei)
+        self.on_vehicle_added_callback(vehicle)
+        return vehicle
+
+    def __register(self, name, sysid, imei):
+        if self.__auto_registered >= self.__max_auto_registered:
+            METRICS.inc('relay_vehicles_rejected_total', (('reason', 'limit'),))
+            return None
+        self.__auto_registered += 1
+        return self.add(name, sysid, imei)
+
+    def by_name(self, name):
+        return self.__by_name.get(name)
+
+    def by_sysid(self, sysid):
+        vehicle = self.__by_sysid.get(sysid, self.__default)
+        if vehicle is None and sysid is not None and self.__auto_register:
+            vehicle = self.__register('sys' + str(sysid), sysid, None)
+        return vehicle
+
+    def by_imei(self, imei, register=True):
+        # only the messages of the plane register a vehicle, not the ones to an imei
+        vehicle = self.__by_imei.get(imei, self.__default)
+        if vehicle is None and imei is not None and self.__auto_register and register:
+            # the imei becomes part of the MQTT topics of the vehicle
+            if not imei.isdigit():
+                METRICS.inc('relay_vehicles_rejected_total', (('reason', 'imei'),))
+                return None
+            vehicle = self.__register(imei, None, imei)
+        return vehicle
+
+    def default(self):
+        return self.__default
+
+    def __iter__(self):
+        return self.__by_name.itervalues()
+
+
+class SessionTable:
+    # Expires keys which were not touched for the timeout using a single timer. Touching a known key
+    # only updates its timestamp, the deadline in the heap is corrected lazily when it is reached.
+    def __init__(self, timeout):
+        self.__timeout = timeout
+        self.__last_seen = {}
+        self.__deadlines = []
+        self.__timer = None
+        self.__timer_deadline = None
+        self.on_expired_callback = None
+
+    def __arm(self):
+        if not self.__deadlines:
+            return
+        deadline = self.__deadlines[0][0]
+        if self.__timer is not None:
+            if self.__timer_deadline <= deadline:
+                return
+            tornado.ioloop.IOLoop.current().remove_timeout(self.__timer)
+        self.__timer_deadline = deadline
+        self.__timer = tornado.ioloop.IOLoop.current().call_later(max(0, deadline - time.time()), self.__on_timer)
+
+    def __on_timer(self):
+        self.__timer = None
+        now = time.time()
+        while self.__deadlines and self.__deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.__deadlines)
+            last_seen = self.__last_seen.get(key)
+            if last_seen is None:
+                continue
+            if last_seen + self.__timeout > now:
+                heapq.heappush(self.__deadlines, (last_seen + self.__timeout, key))
+                continue
+            del self.__last_seen[key]
+            self.on_expired_callback(key, now - last_seen)
+        self.__arm()
+
+    def touch(self, key, now=None):
+        if now is None:
+            now = time.time()
+        new = key not in self.__last_seen
+        self.__last_seen[key] = now
+        if new:
+            heapq.heappush(self.__deadlines, (now + self.__timeout, key))
+            self.__arm()
+        return new
+
+    def __contains__(self, key):
+        return key in self.__last_seen
+
+    def __len__(self):
+        return len(self.__last_seen)
+
+    def stop(self):
+        if self.__timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.__timer)
+            self.__timer = None
+
+
+class SequenceTracker:
+    # Follows the MAVLink sequence numbers of each source (sysid, compid) on the LTE link, like mavutil
+    # does to count the lost messages, but reading only the frame headers. The window holds the frames
+    # of the last sequence numbers of a source: a frame equal to the one with its sequence number in the
+    # window is a duplicate, a frame filling a gap in the window arrived out of order and a gap which
+    # leaves the window is counted as lost.
+    def __init__(self, window):
+        self.__window = window
+        # (sysid, compid) -> [latest sequence number, slots], a slot is False if no frame is expected,
+        # None while the frame is missing and the frame once it was received
+        self.__sources = {}
+
+    def __advance(self, source, seq):
+        # moves the window to seq, returns the number of frames which left it missing
+        lost = 0
+        last, slots = source
+        for i in range(1, ((seq - last) & 0xFF) + 1):
+            leaving = (last + i - self.__window) & 0xFF
+            if slots[leaving] is None:
+                lost += 1
+            slots[leaving] = False
+            slots[(last + i) & 0xFF] = None
+        source[0] = seq
+        return lost
+
+    def check(self, vehicle, data):
+        # returns False if all frames of the datagram are duplicates
+        frames = 0
+        duplicates = 0
+        for offset, length, msgid, sysid, compid, payload_offset, payload_length, seq in mavlink.frame_headers(data):
+            if msgid is None:
+                continue
+            frames += 1
+            frame = data if length == len(data) else data[offset:offset + length]
+            source = self.__sources.get((sysid, compid))
+            if source is None:
+                source = self.__sources[(sysid, compid)] = [seq, [False] * 256]
+            elif ((source[0] - seq) & 0xFF) < self.__window:
+                slot = source[1][seq]
+                if slot == frame:
+                    duplicates += 1
+                    METRICS.inc('relay_lte_duplicates_total', vehicle.labels('lte', 'from_plane'))
+                    continue
+                if slot is None:
+                    METRICS.inc('relay_lte_reordered_total', vehicle.labels('lte', 'from_plane'))
+            elif ((seq - source[0]) & 0xFF) <= 128:
+                lost = self.__advance(source, seq)
+                if lost:
+                    METRICS.inc('relay_lte_lost_total', vehicle.labels('lte', 'from_plane'), lost)
+            else:
+                # behind the window, forwarded without moving it
+                METRICS.inc('relay_lte_reordered_total', vehicle.labels('lte', 'from_plane'))
+                continue
+            source[1][seq] = frame
+        return frames == 0 or duplicates < frames
+
+
 class LteInterface():
-    def __init__(self, rx_port, timeout):
+    def __init__(self, rx_port, timeout, vehicles, batch_size, sequence_window=0, receive_buffer=0, reuse_port=False):
         self.__sock = None
         self.__rx_port = rx_port
-        self.__host_ip = None
-        self.__tx_port = None
+        self.__receive_buffer = receive_buffer
+        self.__reuse_port = reuse_port
+        self.__vehicles = vehicles
+        self.__batch_size = batch_size
+        self.__sequences = SequenceTracker(sequence_window) if sequence_window > 0 else None
         self.__message_counter = 0
         self.__bytes_counter = 0
         self.__last_time = time.time()
-        self.__receive_time = time.time()
-        self.__timeout = timeout
-        self.__timeout_scheduler = None
-        self.__lock = Lock()
-        self.on_message_callback = None
+        self.__sessions = SessionTable(timeout)
+        self.__sessions.on_expired_callback = self.__on_session_expired
+        self.on_batch_callback = None
+        self.on_session_callback = None
 
-    def __on_receive_timeout(self):
-        self.__lock.acquire()
-        if (time.time() - self.__receive_time > self.__timeout):
-            if self.__host_ip:
-                self.__host_ip = None
-                self.__tx_port = None
-                self.__message_counter = 0
-                self.__bytes_counter = 0
-                LOGGER.warn('No LTE message received for {0} seconds, resetting host ip.'.format(time.time() - self.__receive_time))
+    def __on_session_expired(self, name, idle_time):
+        vehicle = self.__vehicles.by_name(name)
+        vehicle.lte_address = None
+        LOGGER.warn('No LTE message received from vehicle "{0}" for {1} seconds, resetting host ip.'.format(name, idle_time))
+        if self.on_session_callback is not None:
+            self.on_session_callback(vehicle)
+        if not self.__sessions:
+            self.__message_counter = 0
+            self.__bytes_counter = 0
             self.__last_time = time.time()
-        self.__lock.release()
 
     def on_receive(self, fd, events):
-        (data, source_ip_port) = self.__sock.recvfrom(4096)
-        self.__lock.acquire()
-        self.__receive_time = time.time()
-
-        self.__message_counter += 1
-        self.__bytes_counter += sys.getsizeof(data) - 37
-        if (self.__message_counter % 1000 == 0):
-            LOGGER.warn('Received LTE data #{0}, rate: {1} kB/s'.format(self.__message_counter, self.__bytes_counter / (1000.0 * (time.time() - self.__last_time))))
-            self.__last_time = time.time()
+        # drain the pending datagrams, up to the batch size, so that a burst costs a single wakeup
+        batch = []
+        # [vehicle, datagrams, bytes] by the name of the vehicle, counted once per batch
+        counts = {}
+        now = time.time()
+        vehicle = None
+        sysid = -1
+        recvfrom = self.__sock.recvfrom
+        while len(batch) < self.__batch_size:
+            try:
+                (data, source_ip_port) = recvfrom(4096)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    LOGGER.warn('Failed to receive LTE data: %s', e)
+                break
+
+            header = mavlink.frame_header(data)
+            datagram_sysid = header[2] if header is not None else None
+            if datagram_sysid != sysid or vehicle is None:
+                sysid = datagram_sysid
+                vehicle = self.__vehicles.by_sysid(sysid)
+                if vehicle is None:
+                    continue
+                count = counts.get(vehicle.name)
+                if count is None:
+                    self.__sessions.touch(vehicle.name, now)
+                    vehicle.lte_last_seen = now
+                    count = counts[vehicle.name] = [vehicle, 0, 0]
+
+            if vehicle.lte_address != source_ip_port:
+                LOGGER.warn('LTE session of vehicle "%s" from %s:%d', vehicle.name, source_ip_port[0], source_ip_port[1])
+                vehicle.lte_address = source_ip_port
+                if self.on_session_callback is not None:
+                    self.on_session_callback(vehicle)
+
+            if self.__sequences is not None and not self.__sequences.check(vehicle, data):
+                continue
+            count[1] += 1
+            count[2] += len(data)
+            batch.append((vehicle, data))
+
+        if not batch:
+            return
+
+        received_bytes = 0
+        for vehicle, datagrams, length in counts.itervalues():
+            labels = vehicle.labels('lte', 'from_plane')
+            METRICS.inc('relay_packets_total', labels, datagrams)
+            METRICS.inc('relay_bytes_total', labels, length)
+            JOURNAL.record(journal.LTE_RECEIVED, journal.LTE, vehicle.name, length, datagrams)
+            received_bytes += length
+
+        previous_counter = self.__message_counter
+        self.__message_counter += len(batch)
+        self.__bytes_counter += received_bytes
+        if (self.__message_counter // 1000 != previous_counter // 1000):
+            LOGGER.warn('Received LTE data #{0}, rate: {1} kB/s'.format(self.__message_counter, self.__bytes_counter / (1000.0 * (now - self.__last_time))))
+            self.__last_time = now
             self.__bytes_counter = 0
-        else:
-            LOGGER.info('Received LTE data #%d', self.__message_counter)
 
-        self.__host_ip = source_ip_port[0]
-        self.__tx_port = source_ip_port[1]
-        self.__lock.release()
-        self.on_message_callback(data)
+        self.on_batch_callback(batch)
 
-    def send(self, data):
-        if (self.__host_ip != None):
-            LOGGER.info('Sending LTE data to %s:%d', self.__host_ip, self.__tx_port)
-            self.__sock.sendto(data, (self.__host_ip, self.__tx_port))
+    def send(self, vehicle, data):
+        address = vehicle.lte_address
+        if (address != None):
+            self.__sock.sendto(data, address)
+            JOURNAL.record(journal.LTE_SENT, journal.LTE, vehicle.name, len(data))
+            labels = vehicle.labels('lte', 'to_plane')
+            METRICS.inc('relay_packets_total', labels)
+            METRICS.inc('relay_bytes_total', labels, len(data))
         else:
-            LOGGER.warn('No IP port available, unable to send over UDP')
+            LOGGER.warn('No IP port available for vehicle "%s", unable to send over UDP', vehicle.name)
 
     def open(self):
         LOGGER.warn('Opening UDP port %d', self.__rx_port)
         self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.__sock.setblocking(False)
+        if self.__receive_buffer > 0:
+            # bursts beyond the buffer are dropped by the kernel, Linux limits it to net.core.rmem_max
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.__receive_buffer)
+        if self.__reuse_port:
+            # the LTE workers share the port, the kernel hashes the address of a vehicle to one of them
+            self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         tornado.ioloop.IOLoop.current().add_handler(self.__sock.fileno(), self.on_receive, tornado.ioloop.IOLoop.READ)
         self.__sock.bind(('', self.__rx_port)) # all available interfaces
-        self.__timeout_scheduler = tornado.ioloop.PeriodicCallback(self.__on_receive_timeout, 1000)
-        self.__timeout_scheduler.start()
 
     def close(self):
         LOGGER.warn('Closing UDP port')
-        self.__timeout_scheduler.stop()
+        self.__sessions.stop()
         tornado.ioloop.IOLoop.current().remove_handler(self.__sock.fileno())
         self.__sock.close()
         self.__sock = None
 
 
+class LteWorkerPool:
+    # Runs the LTE interface in worker processes which share the UDP port with SO_REUSEPORT, so that the
+    # ingest is not limited to a single core. The kernel hashes the address of a vehicle to one worker,
+    # which publishes the messages of the vehicle with its own MQTT client. The workers report their
+    # sessions, the acknowledgements for the link arbitration, the frames for the vehicle state and their
+    # metrics, the downlink messages are handed to the worker which holds the address of the vehicle.
+    def __init__(self, workers, vehicles, target):
+        self.__count = workers
+        self.__vehicles = vehicles
+        self.__target = target
+        self.__workers = []
+        self.__owners = {}
+        self.on_batch_callback = None
+        self.on_state_callback = None
+
+    def __on_session(self, index, sysid, name, address, last_seen):
+        vehicle = self.__vehicles.by_name(name) or self.__vehicles.by_sysid(sysid)
+        if vehicle is None:
+            return
+        owner = self.__owners.get(vehicle.name)
+        if address is not None:
+            if owner is not None and owner != index:
+                # the vehicle changed its address and was hashed to another worker
+                LOGGER.warn('LTE session of vehicle "%s" moved from worker %d to %d', vehicle.name, owner, index)
+                self.__send(owner, ('release', vehicle.name))
+            self.__owners[vehicle.name] = index
+            vehicle.lte_address = address
+            vehicle.lte_last_seen = last_seen
+        elif owner == index:
+            del self.__owners[vehicle.name]
+            vehicle.lte_address = None
+
+    def __on_acks(self, acks):
+        batch = []
+        for name, data in acks:
+            vehicle = self.__vehicles.by_name(name)
+            if vehicle is not None:
+                batch.append((vehicle, data))
+        if batch:
+            self.on_batch_callback(batch)
+
+    def __on_message(self, index, connection, fd, events):
+        try:
+            while connection.poll():
+                message = connection.recv()
+                if message[0] == 'session':
+                    self.__on_session(index, *message[1:])
+                elif message[0] == 'acks':
+                    self.__on_acks(message[1])
+                elif message[0] == 'state':
+                    for name, link, frame, received in message[1]:
+                        self.on_state_callback(name, link, frame, received)
+                elif message[0] == 'metrics':
+                    METRICS.set_remote((('worker', str(index)),), message[1])
+        except (EOFError, IOError):
+            LOGGER.error('LTE worker %d stopped', index)
+            tornado.ioloop.IOLoop.current().remove_handler(fd)
+
+    def __send(self, index, message):
+        try:
+            self.__workers[index][1].send(message)
+        except (IOError, OSError) as e:
+            LOGGER.warn('Failed to reach LTE worker %d: %s', index, e)
+
+    def send(self, vehicle, data):
+        owner = self.__owners.get(vehicle.name)
+        if owner is not None:
+            self.__send(owner, ('send', vehicle.name, data))
+        else:
+            LOGGER.warn('No IP port available for vehicle "%s", unable to send over UDP', vehicle.name)
+
+    def open(self):
+        LOGGER.warn('Starting %d LTE workers', self.__count)
+        for index in range(self.__count):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=self.__target, args=(index, worker_connection), name='lte%d' % index)
+            process.daemon = True
+            process.start()
+            worker_connection.close()
+            self.__workers.append((process, connection))
+            tornado.ioloop.IOLoop.current().add_handler(connection.fileno(), functools.partial(self.__on_message, index, connection),
+                                                        tornado.ioloop.IOLoop.READ)
+
+    def close(self):
+        LOGGER.warn('Stopping the LTE workers')
+        for index, (process, connection) in enumerate(self.__workers):
+            # on Ctrl-C the workers received the interrupt themselves
+            if process.is_alive():
+                self.__send(index, ('stop',))
+        for process, connection in self.__workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+            connection.close()
+        self.__workers = []
+
+
+class TlogRecorder:
+    # Records the MAVLink frames of both links and directions in tlogs per vehicle and link, a tlog
+    # record is the time in microseconds (8 bytes, big endian) followed by the frame. The files are
+    # written by a separate thread so that the IOLoop does not wait for the disk.
+    TIMESTAMP = struct.Struct('>Q')
+
+    def __init__(self, directory, segment_size, segment_duration, compress, max_bytes, queue_size):
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__segment_duration = segment_duration
+        self.__compress = compress
+        self.__max_bytes = max_bytes
+        self.__queue = Queue.Queue(queue_size)
+        self.__thread = None
+        self.__segments = {}
+        METRICS.add_gauge_callback(lambda: [('relay_tlog_queue_depth', (), self.__queue.qsize())])
+
+    def record(self, vehicle, link, data):
+        try:
+            self.__queue.put_nowait((vehicle.name, link, time.time(), data))
+        except Queue.Full:
+            METRICS.inc('relay_tlog_dropped_total')
+
+    def record_batch(self, batch, link):
+        for vehicle, data in batch:
+            self.record(vehicle, link, data)
+
+    def __open(self, name, link, now):
+        directory = os.path.join(self.__directory, name or '_default')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, link + time.strftime('_%Y-%m-%d_%H-%M-%S', time.gmtime(now)))
+        filename = base + '.tlog'
+        suffix = 1
+        while os.path.exists(filename) or os.path.exists(filename + '.gz'):
+            filename = '%s_%d.tlog' % (base, suffix)
+            suffix += 1
+        segment = self.__segments[(name, link)] = [open(filename, 'wb'), filename, now, 0]
+        return segment
+
+    def __close(self, key):
+        f, filename, start_time, size = self.__segments.pop(key)
+        f.close()
+        if self.__compress:
+            with open(filename, 'rb') as src, gzip.open(filename + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(filename)
+
+    def __prune(self):
+        # the oldest finished tlogs of all vehicles are removed while they take more than max_bytes
+        if self.__max_bytes <= 0:
+            return
+        open_files = set(segment[1] for segment in self.__segments.itervalues())
+        total = 0
+        finished = []
+        for directory, subdirectories, names in os.walk(self.__directory):
+            for name in names:
+                if not (name.endswith('.tlog') or name.endswith('.tlog.gz')):
+                    continue
+                filename = os.path.join(directory, name)
+                try:
+                    size = os.path.getsize(filename)
+                    modified = os.path.getmtime(filename)
+                except OSError:
+                    continue
+                total += size
+                if filename not in open_files:
+                    finished.append((modified, filename, size))
+        finished.sort()
+        for modified, filename, size in finished:
+            if total <= self.__max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError as e:
+                LOGGER.warn('Failed to remove the tlog %s: %s', filename, e)
+                continue
+            total -= size
+
+    def __write(self, name, link, received, data):
+        segment = self.__segments.get((name, link))
+        if segment is not None and (segment[3] >= self.__segment_size or received - segment[2] >= self.__segment_duration):
+            self.__close((name, link))
+            self.__prune()
+            segment = None
+        if segment is None:
+            segment = self.__open(name, link, received)
+
+        timestamp = self.TIMESTAMP.pack(int(received * 1e6))
+        for frame, msgid, payload in mavlink_frames(data):
+            if msgid is not None:
+                segment[0].write(timestamp + frame)
+                segment[3] += self.TIMESTAMP.size + len(frame)
+
+    def __run(self):
+        try:
+            self.__prune()
+        except (IOError, OSError) as e:
+            LOGGER.error('Failed to remove the old tlogs: %s', e)
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            try:
+                self.__write(*item)
+                if self.__queue.empty():
+                    for segment in self.__segments.itervalues():
+                        segment[0].flush()
+            except (IOError, OSError) as e:
+                LOGGER.error('Failed to write the tlog of vehicle "%s": %s', item[0], e)
+
+        for key in self.__segments.keys():
+            try:
+                self.__close(key)
+            except (IOError, OSError) as e:
+                LOGGER.error('Failed to close the tlog %s: %s', key, e)
+
+    def start(self):
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        # writes the queued messages before returning
+        self.__queue.put(None)
+        self.__thread.join()
+
+
+class LatencyTracer:
+    # Publishes the relay ingress time of the MO messages and of sampled LTE messages on the trace topic
+    # of the vehicle, udp2mqtt.py matches them with the delivered messages by the CRC of the payload and
+    # reports the latency of its stages back. The vehicle time is taken from SYSTEM_TIME and from
+    # HIGH_LATENCY2 using the boot time learned from SYSTEM_TIME. All clocks need to be synchronized.
+    def __init__(self, sample_interval):
+        self.__sample_interval = sample_interval
+        self.__boot_times = {}
+        self.__next_sample = {}
+        self.on_trace_callback = None
+
+    def __observe(self, vehicle, link, stage, latency):
+        METRICS.observe('relay_latency_seconds', max(0.0, latency), vehicle.labels(link) + (('stage', stage),))
+
+    def __trace(self, vehicle, link, data, received, generated, transmitted):
+        record = dict(link=link, crc=zlib.crc32(data) & 0xffffffff, relay=received, vehicle=generated, transmit=transmitted)
+        self.on_trace_callback(vehicle, json.dumps(record))
+
+    def __on_system_time(self, vehicle, data, received):
+        frame, msgid, payload = next(mavlink_frames(data))
+        try:
+            time_unix_usec, time_boot_ms = _unpack_payload('<QI', payload)
+        except struct.error:
+            return None
+        if time_unix_usec == 0:
+            # the vehicle has no time source yet
+            return None
+        generated = time_unix_usec * 1e-6
+        self.__boot_times[vehicle.name] = generated - time_boot_ms * 1e-3
+        self.__observe(vehicle, 'lte', 'vehicle_to_relay', received - generated)
+        return generated
+
+    def on_lte_batch(self, batch):
+        received = time.time()
+        for vehicle, data in batch:
+            generated = None
+            if mavlink_msgid(data) == MAVLINK_MSG_ID_SYSTEM_TIME:
+                generated = self.__on_system_time(vehicle, data, received)
+            if self.__sample_interval <= 0 or (generated is None and received < self.__next_sample.get(vehicle.name, 0)):
+                continue
+            self.__next_sample[vehicle.name] = received + self.__sample_interval
+            self.__trace(vehicle, 'lte', data, received, generated, None)
+
+    def on_mo_message(self, vehicle, data, received, transmit_time):
+        # Rock7 reports the time of the SBD session in UTC with a resolution of one second
+        transmitted = None
+        if transmit_time:
+            try:
+                transmitted = calendar.timegm(time.strptime(transmit_time, '%y-%m-%d %H:%M:%S'))
+            except ValueError:
+                LOGGER.info('Invalid transmit time %s', transmit_time)
+
+        generated = None
+        boot_time = self.__boot_times.get(vehicle.name)
+        if boot_time is not None:
+            for frame, msgid, payload in mavlink_frames(data):
+                if msgid == MAVLINK_MSG_ID_HIGH_LATENCY2:
+                    generated = boot_time + _unpack_payload('<I', payload)[0] * 1e-3
+                    break
+
+        if transmitted is not None:
+            self.__observe(vehicle, 'satcom', 'iridium_to_relay', received - transmitted)
+            if generated is not None:
+                self.__observe(vehicle, 'satcom', 'vehicle_to_iridium', transmitted - generated)
+        self.__trace(vehicle, 'satcom', data, received, generated, transmitted)
+
+    def on_report(self, vehicle, data):
+        try:
+            for link, stage, latency in json.loads(data):
+                self.__observe(vehicle, str(link), str(stage), latency)
+        except (ValueError, TypeError):
+            LOGGER.warn('Invalid latency report from vehicle "%s"', vehicle.name)
+
+
+class TelemetryDecimator:
+    # Publishes the latest LTE frame per system, component and message id at reduced rates for
+    # viewers on thin links, the full rate stream stays on LTE_from_plane
+    def __init__(self, rates):
+        self.__rates = rates
+        self.__latest = {}
+        self.__last_published = {}
+        self.__schedulers = []
+        self.on_publish_callback = None
+
+    def on_lte_batch(self, batch):
+        if not self.__rates:
+            return
+
+        now = time.time()
+        for vehicle, data in batch:
+            latest = self.__latest.get(vehicle.name)
+            if latest is None:
+                latest = self.__latest[vehicle.name] = (vehicle, {})
+            for offset, length, msgid, sysid, compid, payload_offset, payload_length, seq in mavlink.frame_headers(data):
+                if msgid is not None:
+                    latest[1][(sysid, compid, msgid)] = (data[offset:offset + length], now)
+
+    def __publish(self, rate):
+        now = time.time()
+        since = self.__last_published.get(rate, 0)
+        self.__last_published[rate] = now
+        link = 'LTE_from_plane_%gHz' % rate
+        for vehicle, latest in self.__latest.itervalues():
+            frames = [frame for frame, received in latest.itervalues() if received > since]
+            if frames:
+                self.on_publish_callback(vehicle, link, ''.join(frames))
+
+    def start(self):
+        for rate in self.__rates:
+            scheduler = tornado.ioloop.PeriodicCallback(lambda rate=rate: self.__publish(rate), 1000.0 / rate)
+            scheduler.start()
+            self.__schedulers.append(scheduler)
+
+    def stop(self):
+        for scheduler in self.__schedulers:
+            scheduler.stop()
+
+
+class LteEnveloper:
+    # Collects the LTE datagrams of a vehicle for the window and hands them on as one compressed
+    # envelope, so that they cost a single qos 2 handshake on LTE_from_plane_envelope
+    def __init__(self, window, max_bytes):
+        self.__window = window
+        self.__max_bytes = max_bytes
+        self.__pending = {}
+        self.__ioloop = tornado.ioloop.IOLoop.current()
+        self.on_envelope_callback = None
+
+    def on_lte_batch(self, batch):
+        for vehicle, data in batch:
+            pending = self.__pending.get(vehicle.name)
+            if pending is None:
+                timer = self.__ioloop.call_later(self.__window, self.__flush, vehicle)
+                pending = self.__pending[vehicle.name] = [[], 0, timer]
+            pending[0].append(data)
+            pending[1] += len(data)
+            if pending[1] >= self.__max_bytes:
+                self.__ioloop.remove_timeout(pending[2])
+                self.__flush(vehicle)
+
+    def __flush(self, vehicle):
+        datagrams, length, timer = self.__pending.pop(vehicle.name)
+        data = envelope.encode(datagrams)
+        labels = vehicle.labels('LTE_from_plane_envelope')
+        METRICS.inc('relay_lte_envelopes_total', labels)
+        METRICS.inc('relay_lte_envelope_datagrams_total', labels, len(datagrams))
+        METRICS.inc('relay_lte_envelope_bytes_total', labels + (('stage', 'raw'),), length)
+        METRICS.inc('relay_lte_envelope_bytes_total', labels + (('stage', 'compressed'),), len(data))
+        self.on_envelope_callback(vehicle, data)
+
+    def stop(self):
+        for name, (datagrams, length, timer) in self.__pending.items():
+            self.__ioloop.remove_timeout(timer)
+        self.__pending.clear()
+
+
+class MtOutbox:
+    # Keeps the MT messages until the gateway accepted them. A failed message is retried with backoff
+    # until max_attempts or max_age is reached, a message the gateway rejected for good is dropped.
+    def __init__(self, filename, retry_base, retry_max, max_attempts, max_age, max_in_flight, max_in_flight_per_imei,
+                 vehicles):
+        self.__filename = filename
+        self.__retry_base = retry_base
+        self.__retry_max = retry_max
+        self.__max_attempts = max_attempts
+        self.__max_age = max_age
+        self.__vehicles = vehicles
+        self.__max_in_flight = max_in_flight
+        self.__max_in_flight_per_imei = max_in_flight_per_imei
+        self.__entries = collections.OrderedDict()
+        self.__next_id = 1
+        self.__in_flight = 0
+        self.__in_flight_per_imei = collections.defaultdict(int)
+        self.__timer = None
+        self.deliver_callback = None
+        METRICS.add_gauge_callback(lambda: [('relay_mt_outbox_depth', (), len(self.__entries))])
+
+    def __load(self):
+        if not os.path.exists(self.__filename):
+            return
+
+        try:
+            with open(self.__filename, 'r') as f:
+                state = json.load(f)
+            self.__next_id = state['next_id']
+            now = time.time()
+            # outboxes written before the relay served several vehicles have no imei, they were sent to the single vehicle
+            default = self.__vehicles.default()
+            for stored in state['entries']:
+                imei = stored.get('imei', default.imei if default is not None else None)
+                if imei is None:
+                    LOGGER.error('Dropping MT message # %i of %s, its imei is not known', stored['idx'], self.__filename)
+                    continue
+                entry = dict(id=stored['id'], idx=stored['idx'], imei=imei, data=str(stored['data']).decode('hex'),
+                             attempts=stored['attempts'], next_try=0.0, in_flight=False, queued=stored.get('queued', now))
+                self.__entries[entry['id']] = entry
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            LOGGER.error('Failed to load MT outbox from %s: %s', self.__filename, e)
+            self.__entries.clear()
+        else:
+            if self.__entries:
+                LOGGER.warn('Restored %d MT messages from %s', len(self.__entries), self.__filename)
+
+    def __save(self):
+        entries = [dict(id=e['id'], idx=e['idx'], imei=e['imei'], data=e['data'].encode('hex'), attempts=e['attempts'],
+                        queued=e['queued']) for e in self.__entries.itervalues()]
+        tmp_filename = self.__filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump(dict(next_id=self.__next_id, entries=entries), f)
+            os.rename(tmp_filename, self.__filename)
+        except (IOError, OSError) as e:
+            LOGGER.error('Failed to persist MT outbox to %s: %s', self.__filename, e)
+
+    def __schedule(self):
+        if self.__timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.__timer)
+            self.__timer = None
+
+        now = time.time()
+        next_try = None
+        # imeis whose oldest message waits for a retry, their later messages are held back to keep the order
+        held = set()
+        for entry in self.__entries.itervalues():
+            if self.__in_flight >= self.__max_in_flight:
+                # the next completed request reschedules
+                return
+            if entry['imei'] in held:
+                continue
+            if entry['in_flight'] or self.__in_flight_per_imei[entry['imei']] >= self.__max_in_flight_per_imei:
+                # the completed request of this imei reschedules
+                continue
+            if entry['next_try'] <= now:
+                self.__dispatch(entry)
+            else:
+                held.add(entry['imei'])
+                if next_try is None or entry['next_try'] < next_try:
+                    next_try = entry['next_try']
+
+        if next_try is not None:
+            self.__timer = tornado.ioloop.IOLoop.current().call_later(next_try - now, self.__on_timer)
+
+    def __on_timer(self):
+        self.__timer = None
+        self.__schedule()
+
+    def __dispatch(self, entry):
+        entry['in_flight'] = True
+        self.__in_flight += 1
+        self.__in_flight_per_imei[entry['imei']] += 1
+        self.deliver_callback(entry['imei'], entry['data'], entry['idx'],
+                              lambda success, permanent=False: self.__on_delivered(entry, success, permanent))
+
+    def __drop(self, entry, reason):
+        del self.__entries[entry['id']]
+        vehicle = self.__vehicles.by_imei(entry['imei'], register=False)
+        METRICS.inc('relay_mt_dropped_total', (('vehicle', vehicle.name if vehicle else entry['imei']), ('reason', reason)))
+        LOGGER.error('Dropping MT message # %i after %d attempts (%s)', entry['idx'], entry['attempts'], reason)
+
+    def __on_delivered(self, entry, success, permanent):
+        entry['in_flight'] = False
+        self.__in_flight -= 1
+        self.__in_flight_per_imei[entry['imei']] -= 1
+        entry['attempts'] += 1
+
+        if success:
+            del self.__entries[entry['id']]
+            METRICS.observe('relay_mt_handoff_seconds', time.time() - entry['queued'])
+        elif permanent:
+            self.__drop(entry, 'rejected')
+        elif self.__max_attempts > 0 and entry['attempts'] >= self.__max_attempts:
+            self.__drop(entry, 'attempts')
+        elif self.__max_age > 0 and time.time() - entry['queued'] > self.__max_age:
+            self.__drop(entry, 'outbox_age')
+        else:
+            METRICS.inc('relay_mt_retries_total')
+            # exponential backoff with jitter so that retries after an outage do not arrive all at once
+            delay = min(self.__retry_max, self.__retry_base * 2 ** (entry['attempts'] - 1))
+            delay *= random.uniform(0.5, 1.0)
+            entry['next_try'] = time.time() + delay
+            LOGGER.warn('Retrying MT message # %i in %.1f seconds (attempt %d)', entry['idx'], delay, entry['attempts'] + 1)
+
+        self.__save()
+        self.__schedule()
+
+    def put(self, imei, data, idx):
+        entry = dict(id=self.__next_id, idx=idx, imei=imei, data=data, attempts=0, next_try=0.0, in_flight=False,
+                     queued=time.time())
+        self.__next_id += 1
+        self.__entries[entry['id']] = entry
+        self.__save()
+        self.__schedule()
+
+    def start(self):
+        self.__load()
+        self.__schedule()
+
+    def stop(self):
+        if self.__timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.__timer)
+            self.__timer = None
+        self.__save()
+
+
+class MtAggregator:
+    def __init__(self):
+        self.__frame_counter = 0
+        self.__message_counter = 0
+        self.__credits_unpacked = 0
+        self.__credits_packed = 0
+        self.on_message_callback = None
+
+    def __pack(self, lengths):
+        # Split the payloads, in order, into MT messages such that the total number of credits
+        # is minimal and, for equal cost, the number of SBD sessions is minimal. The scheduler
+        # dropped the payloads longer than an MT message.
+        best = [(0, 0, 0)] + [None] * len(lengths)
+        for end in range(1, len(lengths) + 1):
+            size = 0
+            for start in range(end - 1, -1, -1):
+                size += lengths[start]
+                if size > MT_MAX_LENGTH and start != end - 1:
+                    break
+                cost = (best[start][0] + credits(size), best[start][1] + 1, start)
+                if best[end] is None or cost[:2] < best[end][:2]:
+                    best[end] = cost
+
+        splits = []
+        end = len(lengths)
+        while end > 0:
+            start = best[end][2]
+            splits.append((start, end))
+            end = start
+        splits.reverse()
+        return splits
+
+    def post_messages(self, imei, frames):
+        if not frames:
+            return
+
+        credits_saved = self.credits_saved()
+        for data, idx in frames:
+            self.__frame_counter += 1
+            self.__credits_unpacked += credits(len(data))
+
+        for start, end in self.__pack([len(data) for data, idx in frames]):
+            data = ''.join(data for data, idx in frames[start:end])
+            self.__message_counter += 1
+            self.__credits_packed += credits(len(data))
+            self.on_message_callback(imei, data, frames[start][1])
+
+        METRICS.inc('relay_mt_credits_saved_total', value=self.credits_saved() - credits_saved)
+        LOGGER.info('Packed %d MT payloads into %d messages, saved %d credits (%d bytes) so far',
+                    self.__frame_counter, self.__message_counter, self.credits_saved(), self.credits_saved() * CREDIT_BYTES)
+
+    def credits_saved(self):
+        return self.__credits_unpacked - self.__credits_packed
+
+
+class MtScheduler:
+    # (class, priority, msgids), a lower priority value is sent first
+    CLASSES = [
+        ('command', 0, [11, 75, 76]),                           # SET_MODE, COMMAND_INT, COMMAND_LONG
+        ('param', 1, [20, 21, 23]),                             # PARAM_REQUEST_READ/LIST, PARAM_SET
+        ('mission', 2, [37, 38, 39, 40, 41, 43, 44, 45, 47, 51, 73]),  # MISSION_*
+    ]
+    DEFAULT_CLASS = 'default'
+
+    def __init__(self, vehicle, ttls, hold, max_outstanding, slot_timeout):
+        self.__vehicle = vehicle
+        self.__ttls = ttls
+        self.__hold = hold
+        self.__max_outstanding = max_outstanding
+        self.__slot_timeout = slot_timeout
+        self.__ioloop = tornado.ioloop.IOLoop.current()
+        self.__class_of = {}
+        self.__queues = collections.OrderedDict()
+        for name, priority, msgids in sorted(self.CLASSES, key=lambda c: c[1]):
+            self.__queues[name] = collections.OrderedDict()
+            for msgid in msgids:
+                self.__class_of[msgid] = name
+        self.__queues[self.DEFAULT_CLASS] = collections.OrderedDict()
+        self.__outstanding = collections.deque()
+        self.__unique_key = 0
+        self.__timer = None
+        self.on_release_callback = None
+
+    def __supersession_key(self, msgid, payload):
+        # messages with the same key replace each other, None if the message must always be sent
+        try:
+            if msgid == 23:
+                # PARAM_SET: param_value, target_system, target_component, param_id
+                value, target_system, target_component, param_id = _unpack_payload('<fBB16s', payload)
+                return (msgid, target_system, target_component, param_id.rstrip('\0'))
+            elif msgid == 75:
+                # the parameters are part of the key of the commands, so that only the repetitions of a command
+                # replace each other, e.g. arming and disarming are both sent
+                # COMMAND_INT: 28 bytes of parameters, command, target_system, target_component, frame
+                params, command, target_system, target_component, frame = _unpack_payload('<28sHBBB', payload)
+                return (msgid, target_system, target_component, command, params, frame)
+            elif msgid == 76:
+                # COMMAND_LONG: 28 bytes of parameters, command, target_system, target_component, confirmation,
+                # which is counted up by the retransmissions of the ground station
+                params, command, target_system, target_component = _unpack_payload('<28sHBB', payload)
+                return (msgid, target_system, target_component, command, params)
+            elif msgid == 11:
+                # SET_MODE: custom_mode, target_system
+                custom_mode, target_system = _unpack_payload('<IB', payload)
+                return (msgid, target_system)
+            elif msgid == 41:
+                # MISSION_SET_CURRENT: seq, target_system, target_component
+                seq, target_system, target_component = _unpack_payload('<HBB', payload)
+                return (msgid, target_system, target_component)
+        except struct.error:
+            pass
+        return None
+
+    def post_message(self, data, idx):
+        now = time.time()
+        for frame, msgid, payload in mavlink_frames(data):
+            if len(frame) > MT_MAX_LENGTH:
+                # a signed MAVLink2 frame can be longer than an MT message, the gateway would reject it
+                LOGGER.warn('Dropping MT payload # %i, a frame of %d bytes does not fit into an MT message', idx, len(frame))
+                METRICS.inc('relay_mt_dropped_total', (('vehicle', self.__vehicle.name), ('reason', 'too_long')))
+                continue
+            if not self.__vehicle.reserve(len(frame)):
+                LOGGER.warn('Dropping MT payload # %i, vehicle "%s" has %d bytes queued', idx, self.__vehicle.name, self.__vehicle.queued_bytes)
+                METRICS.inc('relay_mt_dropped_total', (('vehicle', self.__vehicle.name), ('reason', 'memory')))
+                continue
+
+            name = self.__class_of.get(msgid, self.DEFAULT_CLASS)
+            queue = self.__queues[name]
+            key = self.__supersession_key(msgid, payload)
+            if key is None:
+                self.__unique_key += 1
+                key = self.__unique_key
+            elif key in queue:
+                self.__vehicle.release(len(queue.pop(key)[0]))
+                METRICS.inc('relay_mt_dropped_total', (('vehicle', self.__vehicle.name), ('reason', 'superseded')))
+                LOGGER.info('MT message %d superseded by MT payload # %i', msgid, idx)
+            queue[key] = (frame, idx, now)
+
+        self.__kick()
+
+    def __expire(self, now):
+        for name, queue in self.__queues.iteritems():
+            ttl = self.__ttls[name]
+            for key in [key for key, (frame, idx, received) in queue.iteritems() if now - received > ttl]:
+                self.__vehicle.release(len(queue.pop(key)[0]))
+                METRICS.inc('relay_mt_dropped_total', (('vehicle', self.__vehicle.name), ('reason', 'expired_' + name)))
+                LOGGER.warn('Dropping %s MT payload, not sent within %d seconds', name, ttl)
+
+        while self.__outstanding and now - self.__outstanding[0] > self.__slot_timeout:
+            self.__outstanding.popleft()
+
+    def __kick(self):
+        if self.__timer is None and any(self.__queues.itervalues()):
+            # hold back the first message a bit so that bursts end up in the same MT message
+            self.__timer = self.__ioloop.call_later(self.__hold, self.__release)
+
+    def __release(self):
+        self.__timer = None
+        now = time.time()
+        self.__expire(now)
+
+        while len(self.__outstanding) < self.__max_outstanding and any(self.__queues.itervalues()):
+            frames = []
+            size = 0
+            for queue in self.__queues.itervalues():
+                while queue:
+                    key, (frame, idx, received) = next(queue.iteritems())
+                    if frames and size + len(frame) > MT_MAX_LENGTH:
+                        break
+                    del queue[key]
+                    self.__vehicle.release(len(frame))
+                    frames.append((frame, idx))
+                    size += len(frame)
+                if queue:
+                    break
+
+            self.__outstanding.append(now)
+            self.on_release_callback(self.__vehicle.imei, frames)
+
+        if any(self.__queues.itervalues()):
+            # wait for the next SBD session or for the outstanding messages to time out
+            delay = self.__hold
+            if self.__outstanding:
+                delay = max(delay, self.__slot_timeout - (now - self.__outstanding[0]))
+            self.__timer = self.__ioloop.call_later(delay, self.__release)
+
+    def on_session(self):
+        # every SBD session of the plane downloads at most one queued MT message
+        if self.__outstanding:
+            self.__outstanding.popleft()
+        if self.__timer is not None:
+            self.__ioloop.remove_timeout(self.__timer)
+            self.__timer = None
+        self.__kick()
+
+    def stop(self):
+        if self.__timer is not None:
+            self.__ioloop.remove_timeout(self.__timer)
+            self.__timer = None
+
+
+class LinkArbiter:
+    # QGC sends a command over both links if both are configured. While LTE is healthy the SatCom copies
+    # of commands and parameters are held for the grace period and dropped if the plane acknowledged
+    # the LTE copy in the meantime.
+    def __init__(self, grace, lte_healthy_timeout, satcom_healthy_timeout, vehicles):
+        self.__grace = grace
+        self.__lte_healthy_timeout = lte_healthy_timeout
+        self.__satcom_healthy_timeout = satcom_healthy_timeout
+        self.__ioloop = tornado.ioloop.IOLoop.current()
+        self.__held = {}
+        self.__lte_sent = {}
+        self.__lte_acked = {}
+        self.__credits_saved = 0
+        self.on_release_callback = None
+        METRICS.add_gauge_callback(lambda: self.__gauges(vehicles))
+
+    def __gauges(self, vehicles):
+        gauges = []
+        for vehicle in vehicles:
+            gauges.append(('relay_link_healthy', vehicle.labels('lte'), int(self.lte_healthy(vehicle))))
+            gauges.append(('relay_link_healthy', vehicle.labels('satcom'), int(self.satcom_healthy(vehicle))))
+        return gauges
+
+    def lte_healthy(self, vehicle):
+        return (vehicle.lte_address is not None and vehicle.lte_last_seen is not None and
+                time.time() - vehicle.lte_last_seen <= self.__lte_healthy_timeout)
+
+    def satcom_healthy(self, vehicle):
+        return vehicle.mo_last_seen is not None and time.time() - vehicle.mo_last_seen <= self.__satcom_healthy_timeout
+
+    def __uplink_key(self, msgid, payload):
+        # identifies a message sent to the plane by the acknowledgement it causes, None if there is none
+        try:
+            if msgid == 75 or msgid == 76:
+                # COMMAND_INT/COMMAND_LONG: 28 bytes of parameters, command
+                return ('command', _unpack_payload('<28xH', payload)[0])
+            elif msgid == 23:
+                # PARAM_SET: param_value, target_system, target_component, param_id
+                return ('param', _unpack_payload('<fBB16s', payload)[3].rstrip('\0'))
+        except struct.error:
+            pass
+        return None
+
+    def __downlink_key(self, msgid, payload):
+        try:
+            if msgid == MAVLINK_MSG_ID_COMMAND_ACK:
+                # COMMAND_ACK: command, result
+                return ('command', _unpack_payload('<H', payload)[0])
+            elif msgid == MAVLINK_MSG_ID_PARAM_VALUE:
+                # PARAM_VALUE: param_value, param_count, param_index, param_id
+                return ('param', _unpack_payload('<fHH16s', payload)[3].rstrip('\0'))
+        except struct.error:
+            pass
+        return None
+
+    def __expire(self, now):
+        for entries in [self.__lte_sent, self.__lte_acked]:
+            for key in [key for key, sent in entries.iteritems() if now - sent > self.__grace]:
+                del entries[key]
+
+    def __cancel(self, vehicle, frame, idx):
+        saved = credits(len(frame))
+        self.__credits_saved += saved
+        labels = (('vehicle', vehicle.name),)
+        METRICS.inc('relay_link_mt_cancelled_total', labels)
+        METRICS.inc('relay_link_credits_saved_total', labels, saved)
+        LOGGER.warn('Dropping SatCom MT payload # %i, acknowledged over LTE, saved %d credits so far', idx, self.__credits_saved)
+
+    def __release(self, vehicle, key, entry):
+        entries = self.__held[(vehicle.name, key)]
+        entries.remove(entry)
+        if not entries:
+            del self.__held[(vehicle.name, key)]
+        self.on_release_callback(vehicle, entry[0], entry[1])
+
+    def post_satcom(self, vehicle, data, idx):
+        if self.__grace <= 0 or not self.lte_healthy(vehicle):
+            self.on_release_callback(vehicle, data, idx)
+            return
+
+        now = time.time()
+        self.__expire(now)
+        passed = []
+        for frame, msgid, payload in mavlink_frames(data):
+            key = self.__uplink_key(msgid, payload)
+            if key is None:
+                passed.append(frame)
+            elif (vehicle.name, key) in self.__lte_acked:
+                self.__cancel(vehicle, frame, idx)
+            else:
+                entry = [frame, idx, None]
+                entry[2] = self.__ioloop.call_later(self.__grace, self.__release, vehicle, key, entry)
+                self.__held.setdefault((vehicle.name, key), []).append(entry)
+
+        if passed:
+            self.on_release_callback(vehicle, ''.join(passed), idx)
+
+    def on_lte_uplink(self, vehicle, data):
+        now = time.time()
+        for frame, msgid, payload in mavlink_frames(data):
+            key = self.__uplink_key(msgid, payload)
+            if key is not None:
+                self.__lte_sent[(vehicle.name, key)] = now
+
+    def on_lte_batch(self, batch):
+        if not self.__lte_sent:
+            return
+
+        now = time.time()
+        self.__expire(now)
+        for vehicle, data in batch:
+            if not mavlink_has_ack(data):
+                continue
+            for frame, msgid, payload in mavlink_frames(data):
+                key = self.__downlink_key(msgid, payload)
+                if key is None or self.__lte_sent.pop((vehicle.name, key), None) is None:
+                    continue
+                self.__lte_acked[(vehicle.name, key)] = now
+                for held_frame, idx, timer in self.__held.pop((vehicle.name, key), []):
+                    self.__ioloop.remove_timeout(timer)
+                    self.__cancel(vehicle, held_frame, idx)
+
+    def stop(self):
+        for entries in self.__held.itervalues():
+            for frame, idx, timer in entries:
+                self.__ioloop.remove_timeout(timer)
+        self.__held.clear()
+
+
+class MoDeduplicator:
+    # Rock7 retries an MO post if our response was slow or lost, the retries carry the same momsn
+    def __init__(self, filename, size, expiry):
+        self.__filename = filename
+        self.__size = size
+        self.__expiry = expiry
+        self.__seen = collections.OrderedDict()
+
+    def __load(self):
+        if not os.path.exists(self.__filename):
+            return
+
+        try:
+            with open(self.__filename, 'r') as f:
+                for imei, momsn, received in json.load(f):
+                    self.__seen[(imei, momsn)] = received
+        except (IOError, ValueError, TypeError) as e:
+            LOGGER.error('Failed to load the relayed MO messages from %s: %s', self.__filename, e)
+            self.__seen.clear()
+        self.__trim(time.time())
+
+    def __save(self):
+        tmp_filename = self.__filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump([[imei, momsn, received] for (imei, momsn), received in self.__seen.iteritems()], f)
+            os.rename(tmp_filename, self.__filename)
+        except (IOError, OSError) as e:
+            LOGGER.error('Failed to persist the relayed MO messages to %s: %s', self.__filename, e)
+
+    def __trim(self, now):
+        # the entries are ordered by the time they were received
+        while self.__seen:
+            key, received = next(self.__seen.iteritems())
+            if len(self.__seen) <= self.__size and now - received <= self.__expiry:
+                break
+            del self.__seen[key]
+
+    def is_duplicate(self, imei, momsn):
+        try:
+            key = (imei, int(momsn))
+        except (TypeError, ValueError):
+            # without momsn the message can not be identified
+            return False
+
+        self.__trim(time.time())
+        return key in self.__seen
+
+    def remember(self, imei, momsn):
+        # the message was relayed, the retries of Iridium are dropped from now on
+        try:
+            key = (imei, int(momsn))
+        except (TypeError, ValueError):
+            return
+        now = time.time()
+        self.__seen[key] = now
+        self.__trim(now)
+        self.__save()
+
+    def start(self):
+        self.__load()
+
+    def stop(self):
+        self.__save()
+
+
+class MoHistory:
+    # append-only log of the MO payloads of each vehicle, indexed in memory by the time they were received
+    RECORD_HEADER = struct.Struct('<dH')
+
+    def __init__(self, directory, max_age):
+        self.__directory = directory
+        self.__max_age = max_age
+        self.__logs = {}
+        self.__compact_scheduler = None
+
+    def __filename(self, name):
+        return os.path.join(self.__directory, (name or '_default') + '.log')
+
+    def __log(self, name):
+        # [times, offsets, file, size] of the vehicle, the file is opened for appending
+        log = self.__logs.get(name)
+        if log is None:
+            times, offsets = [], []
+            offset = 0
+            filename = self.__filename(name)
+            if os.path.exists(filename):
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                while offset + self.RECORD_HEADER.size <= len(data):
+                    received, length = self.RECORD_HEADER.unpack_from(data, offset)
+                    if offset + self.RECORD_HEADER.size + length > len(data):
+                        break
+                    times.append(received)
+                    offsets.append(offset)
+                    offset += self.RECORD_HEADER.size + length
+                if offset < len(data):
+                    LOGGER.warn('Dropping %d bytes of an incomplete record at the end of %s', len(data) - offset, filename)
+                    with open(filename, 'r+b') as f:
+                        f.truncate(offset)
+            self.__logs[name] = [times, offsets, open(filename, 'ab'), offset]
+            # the compaction replaces the log of the vehicle
+            self.__compact(name)
+            log = self.__logs[name]
+        return log
+
+    def __read(self, name, start):
+        # records from the given index to the end of the log
+        times, offsets, f, size = self.__log(name)
+        if start >= len(offsets):
+            return ''
+        with open(self.__filename(name), 'rb') as log_file:
+            log_file.seek(offsets[start])
+            return log_file.read(size - offsets[start])
+
+    def __compact(self, name):
+        times, offsets, f, size = self.__logs[name]
+        start = bisect.bisect_left(times, time.time() - self.__max_age)
+        if start == 0:
+            return
+
+        data = self.__read(name, start)
+        filename = self.__filename(name)
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as tmp_file:
+                tmp_file.write(data)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError) as e:
+            # the log is left as it is, appending to it continues
+            LOGGER.error('Failed to compact the MO history %s: %s', filename, e)
+            return
+        # the old handle still refers to the replaced file until it is swapped
+        try:
+            compacted = open(filename, 'ab')
+        except IOError as e:
+            # the log is loaded again by the next append
+            LOGGER.error('Failed to reopen the MO history %s: %s', filename, e)
+            compacted = f
+        f.close()
+        base = offsets[start]
+        self.__logs[name] = [times[start:], [offset - base for offset in offsets[start:]], compacted, len(data)]
+
+    def __compact_all(self):
+        for name in self.__logs.keys():
+            self.__compact(name)
+
+    def append(self, vehicle, data, received):
+        log = self.__log(vehicle.name)
+        if log[2].closed:
+            # the file could not be reopened after the compaction
+            del self.__logs[vehicle.name]
+            log = self.__log(vehicle.name)
+        times, offsets, f, size = log
+        record = self.RECORD_HEADER.pack(received, len(data)) + data
+        try:
+            f.write(record)
+            f.flush()
+        except (IOError, ValueError) as e:
+            LOGGER.error('Failed to append to the MO history of vehicle "%s": %s', vehicle.name, e)
+            # the log is loaded and its file reopened on its next use
+            if not f.closed:
+                f.close()
+            self.__logs.pop(vehicle.name, None)
+            return
+        times.append(received)
+        offsets.append(size)
+        log[3] = size + len(record)
+
+    def query(self, vehicle, since):
+        # list of (time received, payload) of the MO messages received since the given time
+        times, offsets, f, size = self.__log(vehicle.name)
+        data = self.__read(vehicle.name, bisect.bisect_left(times, since))
+        records = []
+        offset = 0
+        while offset < len(data):
+            received, length = self.RECORD_HEADER.unpack_from(data, offset)
+            offset += self.RECORD_HEADER.size
+            records.append((received, data[offset:offset + length]))
+            offset += length
+        return records
+
+    def start(self):
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+        self.__compact_scheduler = tornado.ioloop.PeriodicCallback(self.__compact_all, 3600 * 1000)
+        self.__compact_scheduler.start()
+
+    def stop(self):
+        self.__compact_scheduler.stop()
+        for times, offsets, f, size in self.__logs.itervalues():
+            f.close()
+
+
+class HistoryHandler(tornado.web.RequestHandler):
+    # GET /history?vehicle=NAME&seconds=600 returns the MO messages of the last seconds
+    def initialize(self, history, vehicles, default_period):
+        self.history = history
+        self.vehicles = vehicles
+        self.default_period = default_period
+
+    def get(self):
+        vehicle = self.vehicles.by_name(self.get_argument('vehicle', ''))
+        if vehicle is None:
+            raise tornado.web.HTTPError(404)
+        try:
+            period = float(self.get_argument('seconds', self.default_period))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        messages = [[received, data.encode('hex')] for received, data in self.history.query(vehicle, time.time() - period)]
+        self.write(dict(vehicle=vehicle.name, messages=messages))
+
+
+class VehicleState:
+    # Keeps the latest frame of each message type of every vehicle, like the messages of a mavutil
+    # connection. The frames are only stored on the message path, each one is decoded at most once when
+    # a snapshot is requested. The JSON snapshot of a vehicle is rendered again when its state changed,
+    # but not more often than every min_interval, so polling clients share the rendered body and ETag.
+    # While a vehicle has subscribers, its frames are decoded when they arrive and the changed fields
+    # are serialized once for all of them.
+    def __init__(self, min_interval, track_changes=False):
+        self.__min_interval = min_interval
+        self.__parser = mavlink.MAVLink(None)
+        # name -> {msgid: [frame, received, link, decoded, serialized]}
+        self.__latest = {}
+        self.__versions = {}
+        # name -> (version, rendered, etag, body)
+        self.__snapshots = {}
+        self.__generation = int(time.time())
+        self.__changes = {} if track_changes else None
+        # name -> subscribers, the subscribers of all vehicles are kept under None
+        self.__subscribers = collections.defaultdict(set)
+        self.subscribers = 0
+
+    def update(self, name, link, data, received):
+        latest = self.__latest.get(name)
+        if latest is None:
+            latest = self.__latest[name] = {}
+        subscribers = None
+        if self.subscribers:
+            subscribers = self.__subscribers.get(name, set()) | self.__subscribers.get(None, set())
+        for offset, length, msgid, sysid, compid, payload_offset, payload_length, seq in mavlink.frame_headers(data):
+            if msgid is None:
+                continue
+            frame = data if length == len(data) else data[offset:offset + length]
+            entry = [frame, received, link, None, None]
+            if subscribers:
+                self.__push(name, msgid, entry, latest.get(msgid), subscribers)
+            latest[msgid] = entry
+            if self.__changes is not None:
+                self.__changes[(name, msgid)] = (frame, received, link)
+        self.__versions[name] = self.__versions.get(name, 0) + 1
+
+    def on_lte_batch(self, batch):
+        received = time.time()
+        for vehicle, data in batch:
+            self.update(vehicle.name, 'lte', data, received)
+
+    def on_mo_message(self, vehicle, data):
+        self.update(vehicle.name, 'satcom', data, time.time())
+
+    def pop_changes(self):
+        # list of (name, link, frame, received) of the frames stored since the last call
+        changes = [(name, link, frame, received) for (name, msgid), (frame, received, link) in self.__changes.iteritems()]
+        self.__changes.clear()
+        return changes
+
+    def __decode(self, frame):
+        try:
+            message = self.__parser.decode(bytearray(frame))
+            fields = message.to_dict()
+        except (mavlink.MAVError, UnicodeDecodeError) as e:
+            LOGGER.info('Failed to decode a frame for the vehicle state: %s', e)
+            return False
+        name = fields.pop('mavpackettype')
+        for key, value in fields.iteritems():
+            # NaN is not valid JSON
+            if isinstance(value, float) and (value != value or value in (float('inf'), float('-inf'))):
+                fields[key] = None
+        return name, message.get_srcSystem(), message.get_srcComponent(), fields
+
+    def __decoded(self, entry):
+        if entry[3] is None:
+            entry[3] = self.__decode(entry[0])
+        return entry[3]
+
+    @staticmethod
+    def __message(entry, fields):
+        message_type, sysid, compid = entry[3][:3]
+        return dict(received=entry[1], link=entry[2], sysid=sysid, compid=compid, fields=fields)
+
+    def __push(self, name, msgid, entry, previous, subscribers):
+        # sends the fields which changed since the previous message of the type
+        decoded = self.__decoded(entry)
+        if decoded is False:
+            return
+        fields = decoded[3]
+        if previous is not None and self.__decoded(previous):
+            old = previous[3][3]
+            fields = dict((key, value) for key, value in fields.iteritems() if key not in old or old[key] != value)
+            if not fields:
+                return
+        delta = self.__message(entry, fields)
+        delta.update(vehicle=name, type=decoded[0])
+        data = json.dumps(delta, sort_keys=True)
+        METRICS.inc('relay_state_deltas_total')
+        for subscriber in subscribers:
+            subscriber.push(name, msgid, data)
+
+    def message(self, name, msgid):
+        # JSON of the latest message of the type with all fields, None if there is none
+        entry = self.__latest.get(name, {}).get(msgid)
+        if entry is None or self.__decoded(entry) is False:
+            return None
+        if entry[4] is None:
+            message = self.__message(entry, entry[3][3])
+            message.update(vehicle=name, type=entry[3][0])
+            entry[4] = json.dumps(message, sort_keys=True)
+        return entry[4]
+
+    def subscribe(self, subscriber, names):
+        for name in names or [None]:
+            self.__subscribers[name].add(subscriber)
+        self.subscribers += 1
+
+    def unsubscribe(self, subscriber, names):
+        for name in names or [None]:
+            self.__subscribers[name].discard(subscriber)
+        self.subscribers -= 1
+
+    def __render(self, name, version):
+        messages = {}
+        for entry in self.__latest.get(name, {}).itervalues():
+            if self.__decoded(entry) is False:
+                continue
+            messages[entry[3][0]] = self.__message(entry, entry[3][3])
+        return json.dumps(dict(vehicle=name, version=version, messages=messages), sort_keys=True)
+
+    def snapshot(self, vehicle):
+        # (etag, JSON body) of the state of the vehicle
+        version = self.__versions.get(vehicle.name, 0)
+        snapshot = self.__snapshots.get(vehicle.name)
+        now = time.time()
+        if snapshot is not None and (snapshot[0] == version or now - snapshot[1] < self.__min_interval):
+            return snapshot[2], snapshot[3]
+        etag = '"%x-%x"' % (self.__generation, version)
+        body = self.__render(vehicle.name, version)
+        self.__snapshots[vehicle.name] = (version, now, etag, body)
+        METRICS.inc('relay_state_renders_total')
+        return etag, body
+
+
+class StateHandler(tornado.web.RequestHandler):
+    # GET /state?vehicle=NAME returns the latest message of each type of the vehicle, supports If-None-Match
+    def initialize(self, state, vehicles):
+        self.state = state
+        self.vehicles = vehicles
+
+    def get(self):
+        vehicle = self.vehicles.by_name(self.get_argument('vehicle', ''))
+        if vehicle is None:
+            raise tornado.web.HTTPError(404)
+        etag, body = self.state.snapshot(vehicle)
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(body)
+
+
+class StateSocketHandler(tornado.websocket.WebSocketHandler):
+    # WebSocket on /state/live?vehicle=NAME, the vehicle can be repeated, all vehicles are sent without it.
+    # Sends the state of the vehicles as on /state and then the changed fields of each new message. If
+    # max_queued messages are not yet written to a slow client, the changes are dropped and the latest
+    # message of each type which changed meanwhile is sent once the client caught up.
+    def initialize(self, state, vehicles, max_queued, origins):
+        self.state = state
+        self.vehicles = vehicles
+        self.max_queued = max_queued
+        self.origins = origins
+        self.names = []
+        self.in_flight = 0
+        self.stale = set()
+
+    def check_origin(self, origin):
+        if urlparse.urlparse(origin).netloc.lower() in self.origins:
+            return True
+        return super(StateSocketHandler, self).check_origin(origin)
+
+    def prepare(self):
+        for name in self.get_arguments('vehicle'):
+            vehicle = self.vehicles.by_name(name)
+            if vehicle is None:
+                raise tornado.web.HTTPError(404)
+            self.names.append(vehicle.name)
+
+    def open(self):
+        vehicles = [self.vehicles.by_name(name) for name in self.names] if self.names else list(self.vehicles)
+        for vehicle in vehicles:
+            self.__write(self.state.snapshot(vehicle)[1])
+        self.state.subscribe(self, self.names)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.state.unsubscribe(self, self.names)
+
+    def push(self, name, msgid, data):
+        if self.in_flight >= self.max_queued:
+            METRICS.inc('relay_state_deltas_dropped_total')
+            self.stale.add((name, msgid))
+        else:
+            self.__write(data)
+
+    def __write(self, data):
+        try:
+            future = self.write_message(data)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.in_flight += 1
+        future.add_done_callback(self.__on_written)
+
+    def __on_written(self, future):
+        # the exception of a closed connection is handled in on_close
+        future.exception()
+        self.in_flight -= 1
+        if self.in_flight == 0 and self.stale:
+            stale = self.stale
+            self.stale = set()
+            for name, msgid in stale:
+                data = self.state.message(name, msgid)
+                if data is not None:
+                    self.__write(data)
+
+
+def _journal_link(link):
+    return journal.SATCOM if link.startswith('SatCom') else journal.LTE
+
+
+def _count_satcom_message(vehicle, direction, data):
+    labels = vehicle.labels('satcom', direction)
+    METRICS.inc('relay_packets_total', labels)
+    METRICS.inc('relay_bytes_total', labels, len(data))
+    METRICS.inc('relay_credits_total', labels, credits(len(data)))
+
+
 class IridiumInterface:
-    def __init__(self, iridium_url, local_port, rock7_credentials):
+    def __init__(self, iridium_url, local_port, rock7_credentials, outbox, deduplicator, vehicles, max_connections,
+                 connect_timeout, request_timeout, confirm_timeout):
         self.__http_server = None
-        self.__http_client = tornado.httpclient.AsyncHTTPClient()
+        if pycurl is not None:
+            # libcurl keeps the connections to Rock7 alive, so the TLS handshake is not repeated for every message
+            tornado.httpclient.AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+        else:
+            LOGGER.warn('pycurl is not installed, opening a new connection to Rock7 for every MT message')
+        self.__http_client = tornado.httpclient.AsyncHTTPClient(max_clients=max_connections)
+        self.__connect_timeout = connect_timeout
+        self.__request_timeout = request_timeout
+        self.__confirm_timeout = confirm_timeout
         self.__url = iridium_url
         self.__port = local_port
-        self.__waiting_for_confirm = {}
-        self.__post_data = rock7_credentials
-        self.__threads = []
-        self.__lock = Lock()
+        self.__credentials = rock7_credentials
+        self.__outbox = outbox
+        self.__deduplicator = deduplicator
+        self.__vehicles = vehicles
+        self.__outbox.deliver_callback = self.__deliver_message
         self.on_message_callback = None
+        self.on_relayed_callback = None
+        self.on_session_callback = None
+        self.on_trace_callback = None
+        self.handlers = []
 
-    def __on_message_sent(self, response):
-        self.__lock.acquire()
-        idx, data = self.__waiting_for_confirm.pop(response.request)
+    def __deliver_message(self, imei, data, idx, done_callback):
+        vehicle = self.__vehicles.by_imei(imei, register=False)
+        JOURNAL.record(journal.MT_SENT, journal.SATCOM, vehicle.name if vehicle else imei, len(data), idx)
+        post_data = dict(self.__credentials)
+        post_data['imei'] = imei
+        post_data['data'] = data.encode('hex')
+        body = tornado.httputil.urlencode(post_data)
+        request = tornado.httpclient.HTTPRequest(self.__url, method='POST', body=body, connect_timeout=self.__connect_timeout,
+                                                 request_timeout=self.__request_timeout)
+        self.__http_client.fetch(request, lambda response: self.__on_message_sent(response, imei, data, idx, done_callback))
 
-        # clean up threads
-        for thr in self.__threads:
-            if not thr.is_alive():
-                self.__threads.remove(thr)
+    def __record_timing(self, response):
+        METRICS.observe('relay_rock7_post_seconds', response.request_time)
+        # only the curl client reports the phases of a request
+        time_info = response.time_info
+        if 'connect' not in time_info:
+            return
+        METRICS.inc('relay_rock7_connections_total', (('reused', str(time_info['connect'] == 0).lower()),))
+        METRICS.observe('relay_rock7_phase_seconds', time_info.get('queue', 0.0), (('phase', 'queue'),))
+        METRICS.observe('relay_rock7_phase_seconds', time_info['connect'], (('phase', 'connect'),))
+        if time_info.get('appconnect', 0) > 0:
+            METRICS.observe('relay_rock7_phase_seconds', time_info['appconnect'] - time_info['connect'], (('phase', 'tls'),))
+        if time_info.get('starttransfer', 0) > 0:
+            METRICS.observe('relay_rock7_phase_seconds', time_info['starttransfer'] - time_info['pretransfer'],
+                            (('phase', 'server'),))
 
+    def __on_message_sent(self, response, imei, data, idx, done_callback):
+        self.__record_timing(response)
+        # Rock7 reports rejected messages with a 200 response and a FAILED body
         if response.error:
-            LOGGER.warn('Error sending: %s', response.error)
-            thr_redeliver = Thread(target=self.__repost_message, args=(data, idx))
-            thr_redeliver.daemon = True
-            thr_redeliver.start()
-            self.__threads.append(thr_redeliver)
-        
-        self.__lock.release()
-
-    def __repost_message(self, data, idx):
-        time.sleep(10.0)
-        self.post_message(data, idx)
+            LOGGER.warn('Error sending MT message # %i: %s', idx, response.error)
+            done_callback(False)
+        elif response.body and response.body.startswith('FAILED'):
+            LOGGER.warn('Error sending MT message # %i: %s', idx, response.body)
+            # FAILED,CODE,DESCRIPTION
+            fields = response.body.split(',')
+            done_callback(False, len(fields) > 1 and fields[1].strip() in ROCK7_PERMANENT_ERRORS)
+        else:
+            vehicle = self.__vehicles.by_imei(imei, register=False)
+            if vehicle is not None:
+                _count_satcom_message(vehicle, 'to_plane', data)
+                JOURNAL.record(journal.MT_DELIVERED, journal.SATCOM, vehicle.name, len(data), idx, time.time() - response.request_time)
+            done_callback(True)
 
     class PostHandler(tornado.web.RequestHandler):
-        def initialize(self, cb):
+        def initialize(self, cb, relayed_cb, session_cb, trace_cb, vehicles, deduplicator, in_flight, confirm_timeout):
             self.on_msg_callback = cb
+            self.on_relayed_callback = relayed_cb
+            self.on_session_callback = session_cb
+            self.on_trace_callback = trace_cb
+            self.vehicles = vehicles
+            self.deduplicator = deduplicator
+            self.in_flight = in_flight
+            self.confirm_timeout = confirm_timeout
+
+        def on_published(self, vehicle, imei, momsn, msg, received, transmit_time, future):
+            # the message counts as relayed once the broker confirmed it, even if the post timed out
+            self.in_flight.pop((imei, momsn), None)
+            if not future.result():
+                return
+            self.deduplicator.remember(imei, momsn)
+            _count_satcom_message(vehicle, 'from_plane', msg)
+            JOURNAL.record(journal.MO_RECEIVED, journal.SATCOM, vehicle.name, len(msg), int(momsn) if momsn and momsn.isdigit() else 0)
+            self.on_session_callback(vehicle)
+            self.on_trace_callback(vehicle, msg, received, transmit_time)
+            self.on_relayed_callback(vehicle, msg)
 
-        @tornado.web.asynchronous
+        @tornado.gen.coroutine
         def post(self):
-            LOGGER.warn('Received MO message from Iridium')
+            received = time.time()
+            imei = self.get_argument('imei', None)
+            momsn = self.get_argument('momsn', None)
             try:
                 msg = self.request.arguments['data'][0].decode('hex')
             except:
                 LOGGER.warn('Failed to decode the MO message')
                 self.set_status(400)
                 self.finish()
+                return
+
+            vehicle = self.vehicles.by_imei(imei)
+            published = None
+            if vehicle is None:
+                LOGGER.warn('Dropping MO message from unknown imei %s', imei)
+            elif (imei, momsn) in self.in_flight:
+                # a retry of Iridium while the message still waits for the broker gets the same answer
+                LOGGER.warn('MO message # %s of imei %s is already being relayed, waiting for it', momsn, imei)
+                METRICS.inc('relay_mo_duplicates_total', (('vehicle', vehicle.name),))
+                published = self.in_flight[(imei, momsn)]
+            elif self.deduplicator.is_duplicate(imei, momsn):
+                LOGGER.warn('Dropping MO message # %s of imei %s, it was already relayed', momsn, imei)
+                METRICS.inc('relay_mo_duplicates_total', (('vehicle', vehicle.name),))
             else:
-                self.on_msg_callback(msg)
-                self.finish() #TODO check if the message was successfully published
+                vehicle.mo_last_seen = time.time()
+                # The message is not spooled, a spooled message would be lost if the relay stopped before
+                # publishing it. Iridium retries the unconfirmed posts, the session is only handled once.
+                published = self.on_msg_callback(vehicle, msg, False)
+                if momsn and momsn.isdigit():
+                    self.in_flight[(imei, momsn)] = published
+                published.add_done_callback(functools.partial(self.on_published, vehicle, imei, momsn, msg, received,
+                                                              self.get_argument('transmit_time', None)))
 
-    def post_message(self, data, idx):
-        self.__lock.acquire()
-        LOGGER.warn('Sending MT message # %i to Iridium', idx)
-        self.__post_data['data'] = data.encode('hex')
-        body = tornado.httputil.urlencode(self.__post_data)
-        request = tornado.httpclient.HTTPRequest(self.__url, method='POST', body=body)
-        self.__waiting_for_confirm[request] = (idx, data)
-        self.__lock.release()
-        self.__http_client.fetch(request, self.__on_message_sent)
+            if published is not None:
+                # the post is held open until the broker confirmed the message, the IOLoop keeps running
+                try:
+                    confirmed = yield tornado.gen.with_timeout(tornado.ioloop.IOLoop.current().time() + self.confirm_timeout, published)
+                except tornado.gen.TimeoutError:
+                    confirmed = False
+                if not confirmed:
+                    LOGGER.warn('MO message # %s of imei %s was not confirmed by the broker, asking Iridium to retry', momsn, imei)
+                    METRICS.inc('relay_mo_unconfirmed_total', (('vehicle', vehicle.name),))
+                    self.set_status(503)
+            self.finish()
+
+    def post_message(self, imei, data, idx):
+        self.__outbox.put(imei, data, idx)
 
     def start(self):
-        args = dict(cb=self.on_message_callback)
-        self.__http_server = tornado.web.Application([(r"/", self.PostHandler, args)])
+        args = dict(cb=self.on_message_callback, relayed_cb=self.on_relayed_callback, session_cb=self.on_session_callback,
+                    trace_cb=self.on_trace_callback,
+                    vehicles=self.__vehicles, deduplicator=self.__deduplicator, in_flight={}, confirm_timeout=self.__confirm_timeout)
+        self.__http_server = tornado.web.Application([(r"/", self.PostHandler, args)] + self.handlers)
         self.__http_server.listen(self.__port)
+        self.__outbox.start()
         LOGGER.warn('Starting iridum interface on %s', self.__url)
 
+    def stop(self):
+        self.__outbox.stop()
+
+
+class DirectIpInterface:
+    # exchanges the SBD messages with the Iridium gateway over DirectIP instead of the Rock7 HTTP interface
+    # MO session status 0 to 2 are successful sessions
+    MO_SESSION_STATUS_MAX_SUCCESS = 2
+
+    def __init__(self, mo_port, mt_host, mt_port, timeout, confirm_mo, deduplicator, vehicles):
+        self.__mo_port = mo_port
+        self.__mo_server = directip.MoServer(confirm_mo)
+        self.__mo_server.on_message_callback = self.__on_mo_message
+        self.__mt_client = directip.MtClient(mt_host, mt_port, timeout)
+        self.__deduplicator = deduplicator
+        self.__vehicles = vehicles
+        self.on_message_callback = None
+        self.on_relayed_callback = None
+        self.on_session_callback = None
+        self.on_trace_callback = None
+
+    def __on_mo_message(self, imei, momsn, status, session_time, msg):
+        received = time.time()
+        if status > self.MO_SESSION_STATUS_MAX_SUCCESS:
+            LOGGER.warn('Ignoring MO message # %i of a failed SBD session (status %d)', momsn, status)
+            return
+
+        vehicle = self.__vehicles.by_imei(imei)
+        if vehicle is None:
+            LOGGER.warn('Dropping MO message from unknown imei %s', imei)
+            return
+        if self.__deduplicator.is_duplicate(imei, momsn):
+            LOGGER.warn('Dropping MO message # %i of imei %s, it was already relayed', momsn, imei)
+            METRICS.inc('relay_mo_duplicates_total', (('vehicle', vehicle.name),))
+            return
+
+        # the message is spooled if the broker is not reachable, DirectIP does not retry it
+        self.__deduplicator.remember(imei, momsn)
+        vehicle.mo_last_seen = received
+        self.on_session_callback(vehicle)
+        # a mailbox check without MO payload only picks up the queued MT messages
+        if msg:
+            _count_satcom_message(vehicle, 'from_plane', msg)
+            JOURNAL.record(journal.MO_RECEIVED, journal.SATCOM, vehicle.name, len(msg), momsn)
+            self.on_trace_callback(vehicle, msg, received, time.strftime('%y-%m-%d %H:%M:%S', time.gmtime(session_time)))
+            self.on_message_callback(vehicle, msg)
+            self.on_relayed_callback(vehicle, msg)
+
+    def deliver_message(self, imei, data, idx, done_callback):
+        vehicle = self.__vehicles.by_imei(imei, register=False)
+        JOURNAL.record(journal.MT_SENT, journal.SATCOM, vehicle.name if vehicle else imei, len(data), idx)
+        start_time = time.time()
+        try:
+            self.__mt_client.send(imei, idx, data, lambda status: self.__on_message_sent(status, start_time, imei, data, idx, done_callback))
+        except directip.DirectIpError as e:
+            # the message can not be encoded, sending it again fails the same way
+            LOGGER.warn('Error sending MT message # %i: %s', idx, e)
+            done_callback(False, True)
+
+    def __on_message_sent(self, status, start_time, imei, data, idx, done_callback):
+        METRICS.observe('relay_directip_mt_seconds', time.time() - start_time)
+        # a negative status is an error, otherwise it is the position in the MT queue of the gateway
+        if status is None or status < 0:
+            LOGGER.warn('Error sending MT message # %i: status %s', idx, status)
+            done_callback(False, status in DIRECTIP_PERMANENT_ERRORS)
+        else:
+            vehicle = self.__vehicles.by_imei(imei, register=False)
+            if vehicle is not None:
+                _count_satcom_message(vehicle, 'to_plane', data)
+                JOURNAL.record(journal.MT_DELIVERED, journal.SATCOM, vehicle.name, len(data), idx, start_time)
+            done_callback(True)
+
+    def start(self):
+        self.__mo_server.listen(self.__mo_port)
+        LOGGER.warn('Starting DirectIP interface on port %d', self.__mo_port)
+
+    def stop(self):
+        self.__mo_server.stop()
+
 
 class MqttInterface(object):
-    def __init__(self, ip, port, user, pwd, iridium_timeout):
+    def __init__(self, ip, port, user, pwd, iridium_timeout, vehicles, spool, spool_window, client_id='relay_server', subscribe=True):
         self.__broker_ip = ip
         self.__broker_port = port
         self.__broker_user = user
         self.__broker_pwd = pwd
+        self.__vehicles = vehicles
+        self.__client_id = client_id
+        self.__subscribe = subscribe
         self.__client = None
-        self.__client_connected_flag = False
-        self.__client_bad_connection_flag = False
-        self.__publish_counter = 1
+        self.__ioloop = tornado.ioloop.IOLoop.current()
         self.__iridium_counter = 0
-        self.__iridium_timeout = iridium_timeout
-        self.__iridium_queue_cleared = False
-        self.__last_message_received = time.time()
-        self.__timeout_scheduler = None
-        self.__lock = Lock()
+        self.__satcom_sessions = SessionTable(iridium_timeout)
+        self.__satcom_sessions.on_expired_callback = self.__on_receive_timeout
+        self.__pending_publishes = {}
+        self.__connected = False
+        self.__spool = spool
+        self.__spool.on_drop_callback = self.__on_spool_drop
+        self.__spool_window = spool_window
+        self.__spool_in_flight = set()
+        self.__replay_scheduler = None
         self.lte_on_message_callback = None
         self.satcom_on_message_callback = None
+        self.report_on_message_callback = None
+        self.history_on_request_callback = None
 
-    def __on_receive_timeout(self):
-        self.__lock.acquire()
-        if (time.time() - self.__last_message_received > self.__iridium_timeout) and not self.__iridium_queue_cleared:
-            self.__client.publish('telem/SatCom_from_plane', None, qos=0, retain=True)
-            self.__iridium_queue_cleared = True
-            LOGGER.warn('Clear SatCom queue, no message from plane received for {0} seconds'.format(time.time() - self.__last_message_received))
-        self.__lock.release()
+    def __on_receive_timeout(self, name, idle_time):
+        vehicle = self.__vehicles.by_name(name)
+        self.__client.publish(vehicle.topic('SatCom_from_plane'), None, qos=0, retain=True)
+        LOGGER.warn('Clear SatCom queue of vehicle "{0}", no message from plane received for {1} seconds'.format(name, idle_time))
 
     def __connect(self):
-        self.__client = mqtt.Client('relay_server')
+        self.__client = mqtt_ioloop.MqttClient(self.__broker_ip, self.__broker_port, self.__client_id)
         self.__client.on_connect = self.__on_connect
         self.__client.on_message = self.__on_message
         self.__client.on_disconnect = self.__on_disconnect
+        self.__client.on_publish = self.__on_publish
         self.__client.username_pw_set(self.__broker_user, self.__broker_pwd)
 
         self.__client.enable_logger(LOGGER)
 
-        self.__client.loop_start()
-        self.__client.connect(self.__broker_ip, self.__broker_port)
-
-        # wait in loop until connect is done
-        while not self.__client_connected_flag and not self.__client_bad_connection_flag:
-            time.sleep(1)
-
-        if self.__client_bad_connection_flag:
-            self.__client.loop_stop()
-            sys.exit()
+        self.__client.start()
+        self.__replay_scheduler = tornado.ioloop.PeriodicCallback(self.__on_replay_timer, 100)
+        self.__replay_scheduler.start()
 
     def __on_message(self, client, userdata, message):
         LOGGER.warn('Received message from unknown topic: ' + message.topic)
 
     def __on_connect(self, client, userdata, flags, rc):
         if rc==0:
-            self.__client_connected_flag = True
             LOGGER.warn('Connected with result code ' + str(rc))
+            self.__connected = True
+            if self.__spool:
+                LOGGER.warn('Publishing %d bytes of spooled messages', self.__spool.bytes)
+
+            # the LTE workers only publish
+            if not self.__subscribe:
+                return
 
             # Subscribing in on_connect() means that if we lose the connection and
             # reconnect then subscriptions will be renewed.
-            client.subscribe('telem/LTE_to_plane', qos=2)
-            client.subscribe('telem/SatCom_to_plane', qos=2)
-
-            # add the callback to handle the respective queues
-            client.message_callback_add('telem/LTE_to_plane', self.__callback_LTE)
-            client.message_callback_add('telem/SatCom_to_plane', self.__callback_SatCom)
+            for topic in ['telem/LTE_to_plane', 'telem/+/LTE_to_plane']:
+                client.subscribe(topic, qos=2)
+                client.message_callback_add(topic, self.__callback_LTE)
+            for topic in ['telem/SatCom_to_plane', 'telem/+/SatCom_to_plane']:
+                client.subscribe(topic, qos=2)
+                client.message_callback_add(topic, self.__callback_SatCom)
+            for topic in ['telem/latency', 'telem/+/latency']:
+                client.subscribe(topic, qos=0)
+                client.message_callback_add(topic, self.__callback_report)
+            for topic in ['telem/history_request', 'telem/+/history_request']:
+                client.subscribe(topic, qos=1)
+                client.message_callback_add(topic, self.__callback_history_request)
         elif rc == 3:
             LOGGER.warn('Connected failed, server unavailable, retrying in 1 second')
         else:
-            self.bad_connection_flag = True
             LOGGER.error('Connected failed with result code ' + str(rc))
+            self.__ioloop.stop()
 
     def __on_disconnect(self, client, userdata, rc):
-        self.__client_connected_flag = False
         LOGGER.warn('Client disconnecting, reason: ' + str(rc))
+        self.__connected = False
+        self.__spool_in_flight.clear()
+
+    def __on_spool_drop(self, link, reason, count):
+        METRICS.inc('relay_spool_dropped_total', (('link', link), ('reason', reason)), count)
+
+    def __replay(self):
+        # the spooled messages are published in their order with at most spool_window of them waiting
+        # for the broker, each confirmation publishes the next one, so that the spool drains as fast as
+        # the broker takes the messages
+        if not self.__connected or not self.__spool:
+            return
+        while len(self.__spool_in_flight) < self.__spool_window:
+            message = self.__spool.pop()
+            if message is None:
+                LOGGER.warn('Published all spooled messages')
+                return
+            link, topic, data, qos, retain = message
+            info = self.__client.publish(topic, data, qos=qos, retain=retain)
+            if qos > 0:
+                self.__spool_in_flight.add(info.mid)
+
+    def __on_replay_timer(self):
+        self.__spool.flush()
+        self.__replay()
+
+    def __on_publish(self, client, userdata, mid):
+        if mid in self.__spool_in_flight:
+            self.__spool_in_flight.remove(mid)
+            self.__replay()
+            return
+        pending = self.__pending_publishes.pop(mid, None)
+        if pending is not None:
+            vehicle, link, length, publish_time, future = pending
+            vehicle.release(length)
+            JOURNAL.record(journal.MQTT_CONFIRMED, _journal_link(link), vehicle.name, length, mid, publish_time)
+            METRICS.observe('relay_mqtt_publish_seconds', time.time() - publish_time, vehicle.labels(link))
+            if future is not None:
+                future.set_result(True)
+
+    def __vehicle_from_topic(self, topic):
+        # telem/LTE_to_plane or telem/NAME/LTE_to_plane
+        parts = topic.split('/')
+        vehicle = self.__vehicles.by_name(parts[1] if len(parts) == 3 else '')
+        if vehicle is None:
+            LOGGER.warn('Received message for unknown vehicle: ' + topic)
+        return vehicle
 
     def __callback_SatCom(self, client, userdata, msg):
-        self.__iridium_counter += 1
-        LOGGER.info('MQTT received message from ' + msg.topic)
-        self.satcom_on_message_callback(msg.payload, self.__iridium_counter)
+        vehicle = self.__vehicle_from_topic(msg.topic)
+        if vehicle is not None:
+            JOURNAL.record(journal.MQTT_RECEIVED, journal.SATCOM, vehicle.name, len(msg.payload))
+            self.__iridium_counter += 1
+            self.satcom_on_message_callback(vehicle, msg.payload, self.__iridium_counter)
+
+    def __callback_report(self, client, userdata, msg):
+        vehicle = self.__vehicle_from_topic(msg.topic)
+        if vehicle is not None:
+            self.report_on_message_callback(vehicle, msg.payload)
+
+    def __callback_history_request(self, client, userdata, msg):
+        vehicle = self.__vehicle_from_topic(msg.topic)
+        if vehicle is not None:
+            self.history_on_request_callback(vehicle, msg.payload)
 
     def __callback_LTE(self, client, userdata, msg):
-        LOGGER.info('MQTT received message from ' + msg.topic)
-        self.lte_on_message_callback(msg.payload)
+        vehicle = self.__vehicle_from_topic(msg.topic)
+        if vehicle is not None:
+            JOURNAL.record(journal.MQTT_RECEIVED, journal.LTE, vehicle.name, len(msg.payload))
+            self.lte_on_message_callback(vehicle, msg.payload)
+
+    def __publish(self, vehicle, link, data, retain, future=None, spool=True):
+        # the future is resolved with whether the message is safe: confirmed by the broker or spooled
+        topic = vehicle.topic(link)
+        # while the broker is not reachable and until the spool is empty the messages are spooled
+        if not self.__connected or self.__spool:
+            if not spool:
+                future.set_result(False)
+                return
+            if not self.__spool:
+                LOGGER.warn('Broker not reachable, spooling the messages')
+            self.__spool.put(link, topic, data, 2, retain)
+            if future is not None:
+                future.set_result(True)
+            return
+        # the bytes count against the vehicle until the broker confirmed the message
+        if not vehicle.reserve(len(data)):
+            if vehicle.rejected_counter % 100 == 1:
+                LOGGER.warn('Dropping messages to %s, vehicle has %d bytes pending', topic, vehicle.queued_bytes)
+            if future is not None:
+                future.set_result(False)
+            return
+        info = self.__client.publish(topic, data, qos=2, retain=retain)
+        self.__pending_publishes[info.mid] = (vehicle, link, len(data), time.time(), future)
+        JOURNAL.record(journal.MQTT_PUBLISHED, _journal_link(link), vehicle.name, len(data), info.mid)
+
+    def publish_lte_messages(self, batch):
+        for vehicle, data in batch:
+            self.__publish(vehicle, 'LTE_from_plane', data, False)
+
+    def publish_lte_envelope(self, vehicle, data):
+        self.__publish(vehicle, 'LTE_from_plane_envelope', data, False)
+
+    def publish_decimated(self, vehicle, link, data):
+        self.__client.publish(vehicle.topic(link), data, qos=0, retain=False)
 
-    def __publish_message(self, topic, data, retain):
-        self.__client.publish(topic, data, qos=2, retain=retain)
-        self.__publish_counter += 1
-        LOGGER.info('Published message # %i to ' + topic, self.__publish_counter - 1)
+    def publish_history(self, vehicle, reply_id, data):
+        self.__client.publish(vehicle.topic('SatCom_history/' + reply_id), data, qos=1, retain=False)
 
-    def publish_lte_message(self, data):
-        self.__publish_message('telem/LTE_from_plane', data, False)
+    def publish_trace(self, vehicle, data):
+        self.__client.publish(vehicle.topic('trace'), data, qos=0, retain=False)
 
-    def publish_satcom_message(self, data):
-        self.__lock.acquire()
-        self.__iridium_queue_cleared = False
-        self.__last_message_received = time.time()
-        self.__publish_message('telem/SatCom_from_plane', data, True)
-        self.__lock.release()
+    def publish_satcom_message(self, vehicle, data, spool=True):
+        # returns a future resolved once the message is confirmed, or spooled if spool is set
+        self.__satcom_sessions.touch(vehicle.name)
+        future = tornado.concurrent.Future()
+        self.__publish(vehicle, 'SatCom_from_plane', data, True, future, spool)
+        return future
 
     def start(self):
         self.__connect()
-        self.__timeout_scheduler = tornado.ioloop.PeriodicCallback(self.__on_receive_timeout, 2500)
-        self.__timeout_scheduler.start()
 
     def stop(self):
-        self.__client.loop_stop()
-        self.__client.disconnect()
+        self.__replay_scheduler.stop()
+        self.__client.stop()
         self.__client = None
-        self.__timeout_scheduler.stop()
+        self.__satcom_sessions.stop()
         LOGGER.warn('Stopped')
 
 
@@ -278,10 +2361,101 @@ def main():
         pwd = credentials.get('mqtt', 'password')
         rx_port = config.getint('lte', 'target_port')
         lte_timeout = config.getint('lte', 'timeout')
+        lte_batch_size = config.getint('lte', 'batch_size')
+        lte_workers = config.getint('lte', 'workers')
+        lte_sequence_window = config.getint('lte', 'sequence_window')
+        lte_receive_buffer = config.getint('lte', 'receive_buffer')
+        if lte_sequence_window > 128:
+            raise ConfigParser.Error('The LTE sequence window can cover at most 128 sequence numbers')
+        envelope_window = config.getfloat('envelope', 'window')
+        spool_directory = config.get('spool', 'directory')
+        spool_max_bytes = config.getint('spool', 'max_bytes')
+        spool_segment_bytes = config.getint('spool', 'segment_bytes')
+        spool_window = config.getint('spool', 'window')
+        spool_max_ages = {}
+        for link in ['LTE_from_plane', 'LTE_from_plane_envelope']:
+            spool_max_ages[link] = config.getfloat('spool', 'max_age_lte')
+        spool_max_ages['SatCom_from_plane'] = config.getfloat('spool', 'max_age_satcom')
+        envelope_max_bytes = config.getint('envelope', 'max_bytes')
+        trace_sample_interval = config.getfloat('tracing', 'sample_interval')
+        history_directory = config.get('history', 'directory')
+        history_max_age = config.getfloat('history', 'max_age')
+        history_default_period = config.getfloat('history', 'default_period')
+        recorder_enabled = config.getboolean('recorder', 'enabled')
+        recorder_directory = config.get('recorder', 'directory')
+        recorder_segment_size = config.getint('recorder', 'segment_size')
+        recorder_segment_duration = config.getfloat('recorder', 'segment_duration')
+        recorder_compress = config.getboolean('recorder', 'compress')
+        recorder_max_bytes = config.getint('recorder', 'max_bytes')
+        recorder_queue_size = config.getint('recorder', 'queue_size')
+        journal_enabled = config.getboolean('journal', 'enabled')
+        journal_directory = config.get('journal', 'directory')
+        journal_segment_size = config.getint('journal', 'segment_size')
+        journal_max_segments = config.getint('journal', 'max_segments')
+        journal_queue_size = config.getint('journal', 'queue_size')
+        journal_flush_interval = config.getfloat('journal', 'flush_interval')
+        try:
+            journal_sampling = journal.parse_sampling(config.get('journal', 'sampling'))
+        except ValueError as e:
+            raise ConfigParser.Error('Invalid journal sampling: {0}'.format(e))
+        state_enabled = config.getboolean('state', 'enabled')
+        state_min_interval = config.getfloat('state', 'min_interval')
+        state_websocket_queue = config.getint('state', 'websocket_queue')
+        state_websocket_origins = [origin.strip().lower() for origin in config.get('state', 'websocket_origins').split(',')
+                                   if origin.strip()]
+        try:
+            decimation_rates = [float(rate) for rate in config.get('decimation', 'rates').split(',') if rate.strip()]
+        except ValueError as e:
+            raise ConfigParser.Error('Invalid decimation rates: {0}'.format(e))
+        if any(rate <= 0 for rate in decimation_rates):
+            raise ConfigParser.Error('The decimation rates must be positive')
+        iridium_gateway = config.get('iridium', 'gateway')
+        if iridium_gateway not in ['rock7', 'directip']:
+            raise ConfigParser.Error('Unknown Iridium gateway ' + iridium_gateway)
         iridium_url = config.get('iridium', 'url')
         iridium_local_port = config.getint('iridium', 'local_port')
         iridium_timeout = config.getint('iridium', 'timeout')
-        rock7_credentials['imei'] = credentials.get('rockblock', 'imei')
+        outbox_file = config.get('iridium', 'outbox_file')
+        outbox_retry_base = config.getfloat('iridium', 'retry_base')
+        outbox_retry_max = config.getfloat('iridium', 'retry_max')
+        outbox_max_attempts = config.getint('iridium', 'max_attempts')
+        outbox_max_age = config.getfloat('iridium', 'max_age')
+        outbox_max_in_flight = config.getint('iridium', 'max_in_flight')
+        outbox_max_in_flight_per_imei = config.getint('iridium', 'max_in_flight_per_imei')
+        iridium_connect_timeout = config.getfloat('iridium', 'connect_timeout')
+        iridium_request_timeout = config.getfloat('iridium', 'request_timeout')
+        directip_mo_port = config.getint('directip', 'mo_port')
+        directip_mt_host = config.get('directip', 'mt_host')
+        directip_mt_port = config.getint('directip', 'mt_port')
+        directip_timeout = config.getfloat('directip', 'timeout')
+        directip_confirm_mo = config.getboolean('directip', 'confirm_mo')
+        mo_dedup_file = config.get('iridium', 'mo_dedup_file')
+        mo_dedup_size = config.getint('iridium', 'mo_dedup_size')
+        mo_dedup_expiry = config.getfloat('iridium', 'mo_dedup_expiry')
+        mo_confirm_timeout = config.getfloat('iridium', 'mo_confirm_timeout')
+        arbitration_grace = config.getfloat('arbitration', 'grace')
+        arbitration_lte_healthy = config.getfloat('arbitration', 'lte_healthy')
+        arbitration_satcom_healthy = config.getfloat('arbitration', 'satcom_healthy')
+        scheduler_hold = config.getfloat('scheduler', 'hold')
+        scheduler_max_outstanding = config.getint('scheduler', 'max_outstanding')
+        scheduler_slot_timeout = config.getfloat('scheduler', 'slot_timeout')
+        scheduler_ttls = {}
+        for name in ['command', 'param', 'mission', 'default']:
+            scheduler_ttls[name] = config.getfloat('scheduler', 'ttl_' + name)
+        max_queued_bytes = config.getint('vehicles', 'max_queued_bytes')
+        auto_register = config.getboolean('vehicles', 'auto_register')
+        max_auto_registered = config.getint('vehicles', 'max_auto_registered')
+        vehicle_configs = []
+        for section in config.sections():
+            if section.startswith('vehicle '):
+                name = section[len('vehicle '):]
+                # the name is a level of the MQTT topics of the vehicle
+                if not name or any(c in name for c in '/+#'):
+                    raise ConfigParser.Error('Invalid vehicle name "{0}", it must not be empty or contain /, + or #'.format(name))
+                vehicle_configs.append((name, config.getint(section, 'sysid'), config.get(section, 'imei')))
+        if not vehicle_configs:
+            # single vehicle setup, serves all system ids on the telem/... topics
+            vehicle_configs.append(('', None, credentials.get('rockblock', 'imei')))
         rock7_credentials['username'] = credentials.get('rockblock', 'username')
         rock7_credentials['password'] = credentials.get('rockblock', 'password')
 
@@ -296,18 +2470,274 @@ def main():
     formatter = logging.Formatter(LOG_FORMAT)
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
-    mi = MqttInterface(host, port, user, pwd, iridium_timeout)
-    li = LteInterface(rx_port, lte_timeout)
-    ii = IridiumInterface(iridium_url, iridium_local_port, rock7_credentials)
 
-    mi.lte_on_message_callback = li.send
-    mi.satcom_on_message_callback = ii.post_message
-    li.on_message_callback = mi.publish_lte_message
-    ii.on_message_callback = mi.publish_satcom_message
+    def run_lte_worker(index, connection):
+        # the worker handles the LTE traffic of its vehicles with its own IOLoop, MQTT client and spool,
+        # the SatCom link and the arbitration stay in the relay process
+        METRICS.reset()
+        ioloop = tornado.ioloop.IOLoop()
+        ioloop.make_current()
+        wv = VehicleRegistry(max_queued_bytes, auto_register, max_auto_registered)
+        wv.on_vehicle_added_callback = lambda vehicle: None
+        for name, sysid, imei in vehicle_configs:
+            wv.add(name, sysid, imei, default=(sysid is None))
+        wsp = spool.Spool(os.path.join(spool_directory, 'lte%d' % index), spool_max_bytes, spool_segment_bytes, spool_max_ages)
+        METRICS.add_gauge_callback(lambda: [('relay_spool_bytes', (), wsp.bytes)])
+        METRICS.add_gauge_callback(lambda: [('relay_journal_dropped_total', (), JOURNAL.dropped)])
+        wmi = MqttInterface(host, port, user, pwd, iridium_timeout, wv, wsp, spool_window, 'relay_server_lte%d' % index, False)
+        wli = LteInterface(rx_port, lte_timeout, wv, lte_batch_size, lte_sequence_window, lte_receive_buffer, reuse_port=True)
+        wlt = LatencyTracer(trace_sample_interval)
+        wtd = TelemetryDecimator(decimation_rates)
+        wle = None
+        if envelope_window > 0:
+            wle = LteEnveloper(envelope_window, envelope_max_bytes)
+        wtr = None
+        if recorder_enabled:
+            wtr = TlogRecorder(recorder_directory, recorder_segment_size, recorder_segment_duration, recorder_compress,
+                               recorder_max_bytes, recorder_queue_size)
+        wvs = None
+        if state_enabled:
+            wvs = VehicleState(state_min_interval, track_changes=True)
+
+        def on_session(vehicle):
+            connection.send(('session', vehicle.sysid, vehicle.name, vehicle.lte_address, vehicle.lte_last_seen))
+
+        def on_report():
+            # refreshes the sessions in the relay, so that it knows the LTE link of the vehicles is healthy
+            for vehicle in wv:
+                if vehicle.lte_address is not None:
+                    on_session(vehicle)
+            if wvs is not None:
+                connection.send(('state', wvs.pop_changes()))
+            connection.send(('metrics', METRICS.snapshot()))
+
+        def on_batch(batch):
+            if wtr is not None:
+                wtr.record_batch(batch, 'lte')
+            wlt.on_lte_batch(batch)
+            wtd.on_lte_batch(batch)
+            if wvs is not None:
+                wvs.on_lte_batch(batch)
+            if wle is not None:
+                wle.on_lte_batch(batch)
+            else:
+                wmi.publish_lte_messages(batch)
+            acks = [(vehicle.name, data) for vehicle, data in batch if mavlink_has_ack(data)]
+            if acks:
+                connection.send(('acks', acks))
+
+        def on_relay_message(fd, events):
+            try:
+                while connection.poll():
+                    message = connection.recv()
+                    if message[0] == 'send':
+                        vehicle = wv.by_name(message[1])
+                        if wtr is not None:
+                            wtr.record(vehicle, 'lte', message[2])
+                        wli.send(vehicle, message[2])
+                    elif message[0] == 'release':
+                        vehicle = wv.by_name(message[1])
+                        if vehicle is not None:
+                            vehicle.lte_address = None
+                    elif message[0] == 'stop':
+                        ioloop.stop()
+            except (EOFError, IOError):
+                # the relay process is gone
+                ioloop.stop()
+
+        wli.on_batch_callback = on_batch
+        wli.on_session_callback = on_session
+        wlt.on_trace_callback = wmi.publish_trace
+        wtd.on_publish_callback = wmi.publish_decimated
+        if wle is not None:
+            wle.on_envelope_callback = wmi.publish_lte_envelope
+        report_scheduler = tornado.ioloop.PeriodicCallback(on_report, 1000)
+
+        if journal_enabled:
+            JOURNAL.start(journal_directory, 'relay_lte%d' % index, journal_segment_size, journal_max_segments,
+                          journal_queue_size, journal_flush_interval, journal_sampling)
+        if wtr is not None:
+            wtr.start()
+        wli.open()
+        wsp.start()
+        wmi.start()
+        wtd.start()
+        report_scheduler.start()
+        ioloop.add_handler(connection.fileno(), on_relay_message, tornado.ioloop.IOLoop.READ)
+
+        try:
+            ioloop.start()
+        except KeyboardInterrupt:
+            pass
+        report_scheduler.stop()
+        wmi.stop()
+        wli.close()
+        wtd.stop()
+        if wle is not None:
+            wle.stop()
+        wsp.stop()
+        if wtr is not None:
+            wtr.stop()
+        JOURNAL.stop()
+
+    vehicles = VehicleRegistry(max_queued_bytes, auto_register, max_auto_registered)
+    sp = spool.Spool(spool_directory, spool_max_bytes, spool_segment_bytes, spool_max_ages)
+    METRICS.add_gauge_callback(lambda: [('relay_spool_bytes', (), sp.bytes)])
+    METRICS.add_gauge_callback(lambda: [('relay_journal_dropped_total', (), JOURNAL.dropped)])
+    mi = MqttInterface(host, port, user, pwd, iridium_timeout, vehicles, sp, spool_window)
+    if lte_workers > 1:
+        li = LteWorkerPool(lte_workers, vehicles, run_lte_worker)
+    else:
+        li = LteInterface(rx_port, lte_timeout, vehicles, lte_batch_size, lte_sequence_window, lte_receive_buffer)
+    outbox = MtOutbox(outbox_file, outbox_retry_base, outbox_retry_max, outbox_max_attempts, outbox_max_age, outbox_max_in_flight,
+                      outbox_max_in_flight_per_imei, vehicles)
+    mo_deduplicator = MoDeduplicator(mo_dedup_file, mo_dedup_size, mo_dedup_expiry)
+    ii = IridiumInterface(iridium_url, iridium_local_port, rock7_credentials, outbox, mo_deduplicator, vehicles,
+                          outbox_max_in_flight, iridium_connect_timeout, iridium_request_timeout, mo_confirm_timeout)
+    ma = MtAggregator()
+    lt = LatencyTracer(trace_sample_interval)
+    td = TelemetryDecimator(decimation_rates)
+    le = None
+    if envelope_window > 0:
+        le = LteEnveloper(envelope_window, envelope_max_bytes)
+    mh = MoHistory(history_directory, history_max_age)
+    vs = None
+    if state_enabled:
+        vs = VehicleState(state_min_interval)
+    tr = None
+    if recorder_enabled:
+        tr = TlogRecorder(recorder_directory, recorder_segment_size, recorder_segment_duration, recorder_compress,
+                          recorder_max_bytes, recorder_queue_size)
+    la = LinkArbiter(arbitration_grace, arbitration_lte_healthy, arbitration_satcom_healthy, vehicles)
+    di = None
+    if iridium_gateway == 'directip':
+        di = DirectIpInterface(directip_mo_port, directip_mt_host, directip_mt_port, directip_timeout, directip_confirm_mo,
+                               mo_deduplicator, vehicles)
+
+    def on_vehicle_added(vehicle):
+        vehicle.scheduler = MtScheduler(vehicle, scheduler_ttls, scheduler_hold, scheduler_max_outstanding, scheduler_slot_timeout)
+        vehicle.scheduler.on_release_callback = ma.post_messages
+
+    def on_satcom_message(vehicle, data, idx):
+        if vehicle.imei is None:
+            LOGGER.warn('Dropping MT payload # %i, no imei known for vehicle "%s"', idx, vehicle.name)
+        else:
+            la.post_satcom(vehicle, data, idx)
+
+    def on_satcom_release(vehicle, data, idx):
+        vehicle.scheduler.post_message(data, idx)
+
+    def on_mt_message(imei, data, idx):
+        if tr is not None:
+            vehicle = vehicles.by_imei(imei, register=False)
+            if vehicle is not None:
+                tr.record(vehicle, 'satcom', data)
+        ii.post_message(imei, data, idx)
+
+    def on_lte_message(vehicle, data):
+        # the LTE workers record the messages they send themselves
+        if tr is not None and lte_workers <= 1:
+            tr.record(vehicle, 'lte', data)
+        la.on_lte_uplink(vehicle, data)
+        li.send(vehicle, data)
+
+    def on_mo_message(vehicle, data, spool=True):
+        return mi.publish_satcom_message(vehicle, data, spool)
+
+    def on_mo_relayed(vehicle, data):
+        if tr is not None:
+            tr.record(vehicle, 'satcom', data)
+        mh.append(vehicle, data, time.time())
+        if vs is not None:
+            vs.on_mo_message(vehicle, data)
+
+    def on_history_request(vehicle, payload):
+        # 'SECONDS REPLY_ID', the answer is only sent to the ground station which asked for it
+        parts = payload.split()
+        try:
+            period = float(parts[0])
+            reply_id = parts[1]
+        except (ValueError, IndexError):
+            period = reply_id = None
+        if period is None or len(parts) != 2 or not reply_id.isalnum():
+            LOGGER.warn('Invalid MO history request for vehicle "%s": %s', vehicle.name, payload)
+            return
+        records = mh.query(vehicle, time.time() - period)
+        LOGGER.warn('Sending %d MO messages of the last %d seconds of vehicle "%s"', len(records), period, vehicle.name)
+        mi.publish_history(vehicle, reply_id, ''.join(data for received, data in records))
+
+    def on_satcom_session(vehicle):
+        vehicle.scheduler.on_session()
+
+    def on_lte_batch(batch):
+        if tr is not None:
+            tr.record_batch(batch, 'lte')
+        lt.on_lte_batch(batch)
+        la.on_lte_batch(batch)
+        td.on_lte_batch(batch)
+        if vs is not None:
+            vs.on_lte_batch(batch)
+        if le is not None:
+            le.on_lte_batch(batch)
+        else:
+            mi.publish_lte_messages(batch)
+
+    vehicles.on_vehicle_added_callback = on_vehicle_added
+    for name, sysid, imei in vehicle_configs:
+        vehicles.add(name, sysid, imei, default=(sysid is None))
+
+    ii.handlers.append((r"/metrics", MetricsHandler))
+    ii.handlers.append((r"/history", HistoryHandler, dict(history=mh, vehicles=vehicles, default_period=history_default_period)))
+    if vs is not None:
+        ii.handlers.append((r"/state", StateHandler, dict(state=vs, vehicles=vehicles)))
+        ii.handlers.append((r"/state/live", StateSocketHandler, dict(state=vs, vehicles=vehicles, max_queued=state_websocket_queue,
+                                                                     origins=state_websocket_origins)))
+        METRICS.add_gauge_callback(lambda: [('relay_state_subscribers', (), vs.subscribers)])
+
+    mi.lte_on_message_callback = on_lte_message
+    mi.satcom_on_message_callback = on_satcom_message
+    la.on_release_callback = on_satcom_release
+    ma.on_message_callback = on_mt_message
+    mi.report_on_message_callback = lt.on_report
+    if lte_workers > 1:
+        # the workers only hand on the acknowledgements
+        li.on_batch_callback = la.on_lte_batch
+        if vs is not None:
+            li.on_state_callback = vs.update
+    else:
+        li.on_batch_callback = on_lte_batch
+    ii.on_message_callback = on_mo_message
+    ii.on_relayed_callback = on_mo_relayed
+    mi.history_on_request_callback = on_history_request
+    ii.on_session_callback = on_satcom_session
+    ii.on_trace_callback = lt.on_mo_message
+    lt.on_trace_callback = mi.publish_trace
+    td.on_publish_callback = mi.publish_decimated
+    if le is not None:
+        le.on_envelope_callback = mi.publish_lte_envelope
+    if di is not None:
+        # the MT messages are delivered over DirectIP, the Rock7 webhook still accepts MO messages
+        outbox.deliver_callback = di.deliver_message
+        di.on_message_callback = on_mo_message
+        di.on_relayed_callback = on_mo_relayed
+        di.on_session_callback = on_satcom_session
+        di.on_trace_callback = lt.on_mo_message
 
+    # the LTE workers are forked before any other thread is started
     li.open()
+    if journal_enabled:
+        JOURNAL.start(journal_directory, 'relay', journal_segment_size, journal_max_segments, journal_queue_size,
+                      journal_flush_interval, journal_sampling)
+    if tr is not None:
+        tr.start()
+    mo_deduplicator.start()
+    mh.start()
+    if di is not None:
+        di.start()
     ii.start()
+    sp.start()
     mi.start()
+    td.start()
 
     try:
         tornado.ioloop.IOLoop.current().start()
@@ -320,6 +2750,21 @@ def main():
         a = Thread(target=li.close())
         a.start()
         a.join()
+        la.stop()
+        td.stop()
+        if le is not None:
+            le.stop()
+        for vehicle in vehicles:
+            vehicle.scheduler.stop()
+        ii.stop()
+        if di is not None:
+            di.stop()
+        mo_deduplicator.stop()
+        mh.stop()
+        sp.stop()
+        if tr is not None:
+            tr.stop()
+        JOURNAL.stop()
 
 
 if __name__ == '__main__':
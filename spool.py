@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import collections
+import logging
+import os
+import struct
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# time, qos, retain, length of the link, topic and payload, followed by the link, topic and payload
+RECORD_HEADER = struct.Struct('>dBBHHI')
+SEGMENT_SUFFIX = '.spool'
+
+
+class Spool:
+    # Keeps the messages which could not be published while the broker was not reachable, in their
+    # order and up to max_bytes. The messages are written to segment files in the directory, only the
+    # oldest segment is held in memory while it is published, so that the spool survives a restart.
+    # Messages older than the max age of their link are dropped instead of published.
+    def __init__(self, directory, max_bytes, segment_bytes, max_ages):
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        self.__segment_bytes = segment_bytes
+        self.__max_ages = max_ages
+        # [number, bytes] of the segment files, oldest first
+        self.__segments = collections.deque()
+        self.__head = collections.deque()
+        self.__head_loaded = False
+        self.__tail = None
+        self.__next_segment = 0
+        self.bytes = 0
+        self.on_drop_callback = None
+
+    def __nonzero__(self):
+        return bool(self.__segments)
+
+    def __path(self, number):
+        return os.path.join(self.__directory, '%010d%s' % (number, SEGMENT_SUFFIX))
+
+    def __read_segment(self, number):
+        records = []
+        with open(self.__path(number), 'rb') as f:
+            data = f.read()
+        offset = 0
+        while len(data) - offset >= RECORD_HEADER.size:
+            created, qos, retain, link_length, topic_length, payload_length = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            end = offset + link_length + topic_length + payload_length
+            if end > len(data):
+                break
+            link = data[offset:offset + link_length]
+            topic = data[offset + link_length:offset + link_length + topic_length]
+            records.append((created, qos, bool(retain), link, topic, data[end - payload_length:end]))
+            offset = end
+        if offset != len(data):
+            LOGGER.warn('Ignoring %d bytes of a truncated record in %s', len(data) - offset, self.__path(number))
+        return records
+
+    def __write_segment(self, number, records):
+        with open(self.__path(number), 'wb') as f:
+            for created, qos, retain, link, topic, payload in records:
+                f.write(RECORD_HEADER.pack(created, qos, retain, len(link), len(topic), len(payload)) + link + topic + payload)
+
+    def __drop(self, records, reason):
+        counts = collections.Counter(record[3] for record in records)
+        for link, count in counts.items():
+            self.on_drop_callback(link, reason, count)
+
+    def __remove_head(self):
+        number, length = self.__segments.popleft()
+        try:
+            os.remove(self.__path(number))
+        except OSError as e:
+            LOGGER.warn('Failed to remove spool segment: %s', e)
+        self.bytes -= length
+        self.__head.clear()
+        self.__head_loaded = False
+
+    def put(self, link, topic, payload, qos, retain):
+        payload = payload or ''
+        record = RECORD_HEADER.pack(time.time(), qos, retain, len(link), len(topic), len(payload)) + link + topic + payload
+        if self.__tail is None or (self.__segments[-1][1] > 0 and self.__segments[-1][1] + len(record) > self.__segment_bytes):
+            if self.__tail is not None:
+                self.__tail.close()
+            self.__segments.append([self.__next_segment, 0])
+            self.__tail = open(self.__path(self.__next_segment), 'ab')
+            self.__next_segment += 1
+        # the records are flushed in batches by flush()
+        self.__tail.write(record)
+        self.__segments[-1][1] += len(record)
+        self.bytes += len(record)
+
+        # the oldest messages are dropped if the spool is full
+        while self.bytes > self.__max_bytes and len(self.__segments) > 1:
+            if not self.__head_loaded:
+                self.__head.extend(self.__read_segment(self.__segments[0][0]))
+            self.__drop(self.__head, 'overflow')
+            self.__remove_head()
+
+    def flush(self):
+        if self.__tail is not None:
+            self.__tail.flush()
+
+    def pop(self):
+        # returns the oldest message as (link, topic, payload, qos, retain), None if the spool is empty
+        now = time.time()
+        while True:
+            if not self.__head:
+                if self.__head_loaded:
+                    self.__remove_head()
+                if not self.__segments:
+                    return None
+                if len(self.__segments) == 1 and self.__tail is not None:
+                    # the segment is not written anymore once it is read
+                    self.__tail.close()
+                    self.__tail = None
+                self.__head.extend(self.__read_segment(self.__segments[0][0]))
+                self.__head_loaded = True
+                continue
+
+            created, qos, retain, link, topic, payload = self.__head.popleft()
+            max_age = self.__max_ages.get(link, 0)
+            if max_age > 0 and now - created > max_age:
+                self.on_drop_callback(link, 'expired', 1)
+                continue
+            return link, topic, payload, qos, retain
+
+    def start(self):
+        # the messages spooled before a restart are published first
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+        numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.__directory)
+                         if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        for number in numbers:
+            length = os.path.getsize(self.__path(number))
+            self.__segments.append([number, length])
+            self.bytes += length
+        if numbers:
+            self.__next_segment = numbers[-1] + 1
+            LOGGER.warn('Found %d bytes of spooled messages', self.bytes)
+
+    def stop(self):
+        if self.__tail is not None:
+            self.__tail.close()
+            self.__tail = None
+        if self.__head_loaded:
+            # only the messages not yet published are kept
+            number = self.__segments[0][0]
+            if self.__head:
+                self.__write_segment(number, self.__head)
+            else:
+                os.remove(self.__path(number))
@@ -1,23 +1,29 @@
 #!/usr/bin/env python
 
+import collections
 import ConfigParser
+import envelope
+import journal
+import json
 import logging
-import paho.mqtt.client as mqtt
+import mqtt_ioloop
 import socket
+import spool
 from threading import Thread
 import time
 import tornado.web
 import tornado.ioloop
 import tornado.httpclient
 import tornado.httputil
+import uuid
+import zlib
 
 from pymavlink import mavlink
 
 
 LOG_FORMAT = '%(levelname) -10s %(asctime)s %(name) -30s %(funcName) -35s %(lineno) -5d: %(message)s'
 LOGGER = logging.getLogger(__name__)
-
-MAV = mavlink.MAVLink(0)
+JOURNAL = journal.Journal()
 
 
 class UdpInterface():
@@ -25,17 +31,17 @@ class UdpInterface():
         self.__sock = None
         self.__rx_port = rx_port
         self.__tx_port = tx_port
-        self.__type = type
+        self.__link = journal.LTE if type == 'LTE' else journal.SATCOM
         self.on_message_callback = None
 
     def on_receive(self, fd, events):
-        LOGGER.info('Received' + self.__type + ' data on UDP')
         (data, source_ip_port) = self.__sock.recvfrom(4096)
+        JOURNAL.record(journal.UDP_RECEIVED, self.__link, '', len(data))
         self.on_message_callback(data)
 
     def send(self, data):
-        LOGGER.info('Sending' + self.__type + ' data on UDP')
         self.__sock.sendto(data, ('localhost', self.__tx_port))
+        JOURNAL.record(journal.UDP_SENT, self.__link, '', len(data))
 
     def open(self):
         LOGGER.warn('Opening UDP port %d', self.__rx_port)
@@ -51,39 +57,118 @@ class UdpInterface():
         self.__sock = None
 
 
+class LatencyTracker:
+    # Matches the messages forwarded to QGC with the trace records of the relay by the CRC of the payload
+    # and reports the latency of the stages to the relay.
+    MAX_PENDING = 1000
+
+    def __init__(self, report_interval):
+        self.__report_interval = report_interval
+        self.__deliveries = {'lte': collections.OrderedDict(), 'satcom': collections.OrderedDict()}
+        self.__traces = {'lte': collections.OrderedDict(), 'satcom': collections.OrderedDict()}
+        self.__samples = []
+        self.__report_scheduler = None
+        self.on_report_callback = None
+
+    def __remember(self, pending, crc, value):
+        pending[crc] = value
+        if len(pending) > self.MAX_PENDING:
+            pending.popitem(last=False)
+
+    def __match(self, link, trace, received, sent):
+        self.__samples.append((link, 'relay_to_bridge', received - trace['relay']))
+        self.__samples.append((link, 'bridge_to_gcs', sent - received))
+        if trace.get('vehicle'):
+            self.__samples.append((link, 'total', sent - trace['vehicle']))
+
+    def on_delivery(self, link, data, received, sent):
+        crc = zlib.crc32(data) & 0xffffffff
+        trace = self.__traces[link].pop(crc, None)
+        if trace is None:
+            self.__remember(self.__deliveries[link], crc, (received, sent))
+        else:
+            self.__match(link, trace, received, sent)
+
+    def on_trace(self, data):
+        try:
+            trace = json.loads(data)
+            link = trace['link']
+            crc = trace['crc']
+        except (ValueError, KeyError, TypeError):
+            LOGGER.warn('Invalid trace record received')
+            return
+
+        if link in self.__deliveries:
+            delivery = self.__deliveries[link].pop(crc, None)
+            if delivery is None:
+                self.__remember(self.__traces[link], crc, trace)
+            else:
+                self.__match(link, trace, delivery[0], delivery[1])
+
+    def __report(self):
+        samples = self.__samples
+        self.__samples = []
+        if not samples:
+            return
+
+        stages = collections.defaultdict(list)
+        for link, stage, latency in samples:
+            stages[(link, stage)].append(latency)
+        for (link, stage), latencies in sorted(stages.items()):
+            latencies.sort()
+            LOGGER.warn('Latency %s %s: n=%d p50=%.3fs p90=%.3fs p99=%.3fs max=%.3fs', link, stage, len(latencies),
+                        latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.9)],
+                        latencies[int(len(latencies) * 0.99)], latencies[-1])
+        self.on_report_callback(json.dumps(samples))
+
+    def start(self):
+        self.__report_scheduler = tornado.ioloop.PeriodicCallback(self.__report, self.__report_interval * 1000)
+        self.__report_scheduler.start()
+
+    def stop(self):
+        self.__report_scheduler.stop()
+
+
 class MqttInterface(object):
-    def __init__(self, ip, port, user, pwd):
+    def __init__(self, ip, port, user, pwd, vehicle, lte_rate, satcom_history, spool, spool_window):
+        self.__satcom_history = satcom_history
+        # the relay answers the history requests of this bridge on its own topic
+        self.__history_topic = 'telem/' + (vehicle + '/' if vehicle else '') + 'SatCom_history/' + uuid.uuid4().hex
+        self.__disconnect_time = None
+        self.__lte_rate = lte_rate
+        self.__vehicle = vehicle
+        self.__topic_prefix = 'telem/' + vehicle + '/' if vehicle else 'telem/'
+        self.__lte_topic = self.__topic_prefix + 'LTE_from_plane' + ('_%gHz' % lte_rate if lte_rate else '')
         self.__broker_ip = ip
         self.__broker_port = port
         self.__broker_user = user
         self.__broker_pwd = pwd
         self.__client = None
         self.__client_connected_flag = False
-        self.__client_bad_connection_flag = False
-        self.__publish_counter = 1
+        self.__ioloop = tornado.ioloop.IOLoop.current()
         self.__rejection_counter = 0
+        self.__spool = spool
+        self.__spool.on_drop_callback = self.__on_spool_drop
+        self.__spool_window = spool_window
+        self.__spool_in_flight = set()
+        self.__spool_dropped = collections.Counter()
+        self.__replay_scheduler = None
         self.lte_on_message_callback = None
         self.satcom_on_message_callback = None
+        self.delivery_callback = None
+        self.trace_on_message_callback = None
 
     def __connect(self):
-        self.__client = mqtt.Client()
+        self.__client = mqtt_ioloop.MqttClient(self.__broker_ip, self.__broker_port)
         self.__client.on_connect = self.__on_connect
         self.__client.on_message = self.__on_message
         self.__client.on_disconnect = self.__on_disconnect
+        self.__client.on_publish = self.__on_publish
         self.__client.username_pw_set(self.__broker_user, self.__broker_pwd)
 
         self.__client.enable_logger(LOGGER)
 
-        self.__client.loop_start()
-        self.__client.connect(self.__broker_ip, self.__broker_port)
-
-        # wait in loop until connect is done
-        while not self.__client_connected_flag and not self.__client_bad_connection_flag:
-            time.sleep(1)
-
-        if self.__client_bad_connection_flag:
-            self.__client.loop_stop()
-            sys.exit()
+        self.__client.start()
 
     def __on_message(self, client, userdata, message):
         LOGGER.warn('Received message from unknown topic: ' + message.topic)
@@ -95,67 +180,147 @@ class MqttInterface(object):
 
             # Subscribing in on_connect() means that if we lose the connection and
             # reconnect then subscriptions will be renewed.
-            client.subscribe('telem/LTE_from_plane', qos=2)
-            client.subscribe('telem/SatCom_from_plane', qos=2)
+            client.subscribe(self.__lte_topic, qos=2)
+            client.subscribe(self.__topic_prefix + 'SatCom_from_plane', qos=2)
 
             # add the callback to handle the respective queues
-            client.message_callback_add('telem/LTE_from_plane', self.__callback_LTE)
-            client.message_callback_add('telem/SatCom_from_plane', self.__callback_SatCom)
+            client.message_callback_add(self.__lte_topic, self.__callback_LTE)
+            client.message_callback_add(self.__topic_prefix + 'SatCom_from_plane', self.__callback_SatCom)
+
+            # the relay can batch the full rate stream into envelopes, see [envelope] in relay.cfg
+            if not self.__lte_rate:
+                client.subscribe(self.__topic_prefix + 'LTE_from_plane_envelope', qos=2)
+                client.message_callback_add(self.__topic_prefix + 'LTE_from_plane_envelope', self.__callback_LTE_envelope)
+
+            client.subscribe(self.__topic_prefix + 'trace', qos=0)
+            client.message_callback_add(self.__topic_prefix + 'trace', self.__callback_trace)
+
+            # request the recent SatCom messages from the relay, so that QGC does not need to wait for
+            # several SatCom sessions to know the state of the plane, after a reconnect only the ones
+            # missed while disconnected
+            if self.__satcom_history > 0:
+                period = self.__satcom_history
+                if self.__disconnect_time is not None:
+                    period = min(period, time.time() - self.__disconnect_time + 1)
+                client.subscribe(self.__history_topic, qos=1)
+                client.message_callback_add(self.__history_topic, self.__callback_SatCom_history)
+                client.publish(self.__topic_prefix + 'history_request', '%f %s' % (period, self.__history_topic.split('/')[-1]), qos=1)
         elif rc == 3:
             LOGGER.warn('Connected failed, server unavailable, retrying in 1 second')
         else:
-            self.bad_connection_flag = True
             LOGGER.error('Connected failed with result code ' + str(rc))
+            self.__ioloop.stop()
 
     def __on_disconnect(self, client, userdata, rc):
+        if self.__client_connected_flag:
+            self.__disconnect_time = time.time()
         self.__client_connected_flag = False
+        self.__spool_in_flight.clear()
         LOGGER.warn('Client disconnecting, reason: ' + str(rc))
 
     def __callback_SatCom(self, client, userdata, msg):
-        LOGGER.warn('MQTT received message from ' + msg.topic)
+        received = time.time()
+        JOURNAL.record(journal.MQTT_RECEIVED, journal.SATCOM, self.__vehicle, len(msg.payload))
         self.satcom_on_message_callback(msg.payload)
+        self.delivery_callback('satcom', msg.payload, received, time.time())
+
+    def __callback_SatCom_history(self, client, userdata, msg):
+        LOGGER.warn('MQTT received %d bytes of SatCom history', len(msg.payload))
+        if msg.payload:
+            self.satcom_on_message_callback(msg.payload)
 
     def __callback_LTE(self, client, userdata, msg):
-        LOGGER.info('MQTT received message from ' + msg.topic)
+        received = time.time()
+        JOURNAL.record(journal.MQTT_RECEIVED, journal.LTE, self.__vehicle, len(msg.payload))
         self.lte_on_message_callback(msg.payload)
+        self.delivery_callback('lte', msg.payload, received, time.time())
 
-    def __publish_message(self, topic, data):
-        self.__client.publish(topic, data, qos=2, retain=False)
-        self.__publish_counter += 1
-        LOGGER.info('Published message # %i to ' + topic, self.__publish_counter - 1)
+    def __callback_LTE_envelope(self, client, userdata, msg):
+        received = time.time()
+        try:
+            datagrams = envelope.decode(msg.payload)
+        except envelope.EnvelopeError as e:
+            LOGGER.warn('Dropping invalid envelope from %s: %s', msg.topic, e)
+            return
+        JOURNAL.record(journal.MQTT_RECEIVED, journal.LTE, self.__vehicle, len(msg.payload), len(datagrams))
+        for data in datagrams:
+            self.lte_on_message_callback(data)
+            self.delivery_callback('lte', data, received, time.time())
+
+    def __callback_trace(self, client, userdata, msg):
+        self.trace_on_message_callback(msg.payload)
+
+    def __on_spool_drop(self, link, reason, count):
+        self.__spool_dropped[(link, reason)] += count
+        if reason == 'overflow':
+            LOGGER.warn('Spool full, dropped %d %s messages', count, link)
+
+    def __replay(self):
+        # the spooled messages are published in their order with at most spool_window of them waiting
+        # for the broker, each confirmation publishes the next one
+        if not self.__client_connected_flag or not self.__spool:
+            return
+        while len(self.__spool_in_flight) < self.__spool_window:
+            message = self.__spool.pop()
+            if message is None:
+                LOGGER.warn('Published all spooled messages')
+                for (link, reason), count in sorted(self.__spool_dropped.items()):
+                    LOGGER.warn('Dropped %d spooled %s messages (%s)', count, link, reason)
+                self.__spool_dropped.clear()
+                return
+            link, topic, data, qos, retain = message
+            info = self.__client.publish(topic, data, qos=qos, retain=retain)
+            if qos > 0:
+                self.__spool_in_flight.add(info.mid)
+
+    def __on_replay_timer(self):
+        self.__spool.flush()
+        self.__replay()
+
+    def __on_publish(self, client, userdata, mid):
+        if mid in self.__spool_in_flight:
+            self.__spool_in_flight.remove(mid)
+            self.__replay()
+
+    def __publish_message(self, link, data):
+        topic = self.__topic_prefix + link
+        # while the broker is not reachable and until the spool is empty the messages are spooled
+        if not self.__client_connected_flag or self.__spool:
+            if not self.__spool:
+                LOGGER.warn('Broker not reachable, spooling the messages')
+            self.__spool.put(link, topic, data, 2, False)
+            return
+        info = self.__client.publish(topic, data, qos=2, retain=False)
+        JOURNAL.record(journal.MQTT_PUBLISHED, journal.SATCOM if link.startswith('SatCom') else journal.LTE, self.__vehicle,
+                       len(data), info.mid)
+
+    def publish_latency_report(self, data):
+        self.__client.publish(self.__topic_prefix + 'latency', data, qos=0, retain=False)
 
     def publish_lte_message(self, data):
-        self.__publish_message('telem/LTE_to_plane', data)
+        self.__publish_message('LTE_to_plane', data)
 
     def publish_satcom_message(self, data):
-        # check if the message is a valid one
-        m = None
-        try:
-            m = MAV.parse_buffer(data)
-        except:
-            pass
-        try:
-            if m is not None:
-                for msg in m:
-                    if (msg.get_msgId() == 69):
-                        self.__rejection_counter += 1
+        # MANUAL_CONTROL is not sent over SatCom
+        for offset, length, msgid, sysid, compid, payload_offset, payload_length, seq in mavlink.frame_headers(data):
+            if msgid == mavlink.MAVLINK_MSG_ID_MANUAL_CONTROL:
+                self.__rejection_counter += 1
 
-                        if self.__rejection_counter == 100:
-                            self.__rejection_counter = 0
-                            LOGGER.warn('Satcom: Blocking MANUAL_CONTROL message')
-                        return
-        except:
-            pass
+                if self.__rejection_counter == 100:
+                    self.__rejection_counter = 0
+                    LOGGER.warn('Satcom: Blocking MANUAL_CONTROL message')
+                return
 
-        LOGGER.warn('Send SatCom message to plane')
-        self.__publish_message('telem/SatCom_to_plane', data)
+        self.__publish_message('SatCom_to_plane', data)
 
     def start(self):
         self.__connect()
+        self.__replay_scheduler = tornado.ioloop.PeriodicCallback(self.__on_replay_timer, 100)
+        self.__replay_scheduler.start()
 
     def stop(self):
-        self.__client.loop_stop()
-        self.__client.disconnect()
+        self.__replay_scheduler.stop()
+        self.__client.stop()
         self.__client = None
         LOGGER.warn('Stopped')
 
@@ -170,12 +335,40 @@ def main():
         credentials.read(credentials_file)
         host = config.get('mqtt', 'hostname')
         port = config.getint('mqtt', 'port')
+        vehicle = config.get('mqtt', 'vehicle')
+        # the topic of the rate has to match the one the relay publishes to, e.g. LTE_from_plane_0.1Hz
+        lte_rate = None
+        if config.get('mqtt', 'lte_rate').strip():
+            try:
+                lte_rate = float(config.get('mqtt', 'lte_rate'))
+            except ValueError as e:
+                raise ConfigParser.Error('Invalid LTE rate: {0}'.format(e))
+            if lte_rate <= 0:
+                raise ConfigParser.Error('The LTE rate must be positive')
         user = credentials.get('mqtt', 'user')
         pwd = credentials.get('mqtt', 'password')
         lte_rx_port = config.getint('lte', 'target_port')
         lte_tx_port = config.getint('lte', 'listening_port')
         satcom_rx_port = config.getint('satcom', 'target_port')
         satcom_tx_port = config.getint('satcom', 'listening_port')
+        satcom_history = config.getfloat('satcom', 'history')
+        report_interval = config.getfloat('tracing', 'report_interval')
+        spool_directory = config.get('spool', 'directory')
+        spool_max_bytes = config.getint('spool', 'max_bytes')
+        spool_segment_bytes = config.getint('spool', 'segment_bytes')
+        spool_window = config.getint('spool', 'window')
+        spool_max_ages = {'LTE_to_plane': config.getfloat('spool', 'max_age_lte'),
+                          'SatCom_to_plane': config.getfloat('spool', 'max_age_satcom')}
+        journal_enabled = config.getboolean('journal', 'enabled')
+        journal_directory = config.get('journal', 'directory')
+        journal_segment_size = config.getint('journal', 'segment_size')
+        journal_max_segments = config.getint('journal', 'max_segments')
+        journal_queue_size = config.getint('journal', 'queue_size')
+        journal_flush_interval = config.getfloat('journal', 'flush_interval')
+        try:
+            journal_sampling = journal.parse_sampling(config.get('journal', 'sampling'))
+        except ValueError as e:
+            raise ConfigParser.Error('Invalid journal sampling: {0}'.format(e))
     except ConfigParser.Error as e:
         print('Error reading configuration files ' + config_file + ' and ' + credentials_file + ':')
         print(e)
@@ -187,24 +380,35 @@ def main():
     formatter = logging.Formatter(LOG_FORMAT)
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
-    mi = MqttInterface(host, port, user, pwd)
+    sp = spool.Spool(spool_directory, spool_max_bytes, spool_segment_bytes, spool_max_ages)
+    mi = MqttInterface(host, port, user, pwd, vehicle, lte_rate, satcom_history, sp, spool_window)
     li = UdpInterface(lte_rx_port, lte_tx_port, 'LTE')
     si = UdpInterface(satcom_rx_port, satcom_tx_port, 'SatCom')
+    lt = LatencyTracker(report_interval)
 
     mi.lte_on_message_callback = li.send
     mi.satcom_on_message_callback = si.send
     li.on_message_callback = mi.publish_lte_message
     si.on_message_callback = mi.publish_satcom_message
+    mi.delivery_callback = lt.on_delivery
+    mi.trace_on_message_callback = lt.on_trace
+    lt.on_report_callback = mi.publish_latency_report
 
+    if journal_enabled:
+        JOURNAL.start(journal_directory, 'udp2mqtt', journal_segment_size, journal_max_segments, journal_queue_size,
+                      journal_flush_interval, journal_sampling)
     li.open()
     si.open()
-    mi.start() # needs to be called last because the mqtt loop is started in here
+    sp.start()
+    mi.start()
+    lt.start()
 
     try:
         tornado.ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
         # start the stopping in a separate thread so that is not
         # stopped by the KeyboardInterrupt
+        lt.stop()
         a = Thread(target=mi.stop())
         a.start()
         a.join()
@@ -214,6 +418,8 @@ def main():
         a = Thread(target=li.close())
         a.start()
         a.join()
+        sp.stop()
+        JOURNAL.stop()
 
 if __name__ == '__main__':
     main()